@@ -1,24 +1,24 @@
 import streamlit as st
 import vertexai
 from vertexai.generative_models import GenerativeModel, Tool, Part, Content, ChatSession, FunctionDeclaration
-import requests
 import json
-import google.auth.transport.requests
-import google.oauth2.id_token
 import os
-from google.cloud import discoveryengine_v1 as discoveryengine
 from keplergl import KeplerGl
 import streamlit.components.v1 as components
 import pandas as pd
+import hashlib
+from map_lod import apply_lod
+from sql_client import get_client as get_sql_client
+from rag_client import get_client as get_rag_client
+from config_registry import registry as config_registry
+from model_registry import registry as model_registry
+from tool_loop import run_tool_loop
+from events import event_sink, format_event
+from tracing import span
 
 # --- CONFIGURATION ---
 PROJECT_ID = "resiliencegenomeai"
 LOCATION = "us-central1"
-# Your Cloud Run Tool URL (for SQL execution)
-TOOL_URL = "https://resilitix-sql-tool-525917099044.us-central1.run.app"
-
-# RAG CONFIGURATION (UPDATED WITH YOUR ID)
-RAG_DATA_STORE_ID = "resilitix-rag-data_1765252053186" 
 
 # Page Config
 st.set_page_config(page_title="Resilitix AI", page_icon="⚡", layout="wide")
@@ -30,6 +30,8 @@ if "vertex_init" not in st.session_state:
 
 if "map_data" not in st.session_state:
     st.session_state.map_data = None
+if "map_fingerprint" not in st.session_state:
+    st.session_state.map_fingerprint = None
 if "map_config" not in st.session_state:
     # st.session_state.map_config = {}
     st.session_state.map_config = {
@@ -39,42 +41,19 @@ if "map_config" not in st.session_state:
     }
 }
 
-# --- HELPER: GET AUTH TOKEN ---
-def get_id_token(url):
-    """
-    Generates a Google ID Token to authenticate with the Cloud Run tool.
-    """
-    auth_req = google.auth.transport.requests.Request()
-    return google.oauth2.id_token.fetch_id_token(auth_req, url)
-
 # --- HELPER: LOAD CONFIGURATION ---
-def load_config():
+def build_system_prompt(config) -> str:
     """
-    Reads instructions.md and examples.json to build the system prompt.
+    Builds the orchestrator system prompt from instructions.md and examples.json.
     """
     # 1. Load Rules from instructions.md
-    try:
-        config_path = os.path.join(os.path.dirname(__file__), "config", "instructions.md")
-        with open(config_path, "r") as f:
-            base_instructions = f.read()
-    except FileNotFoundError:
-        base_instructions = """
+    base_instructions = config.instructions(default="""
         Role: You are an expert Data Analyst and Knowledge Assistant for Resilitix. 
         Your goal is to answer user questions using the appropriate tool.
-        """
+        """)
 
     # 2. Load Examples from examples.json (SQL examples still useful for context)
-    try:
-        examples_path = os.path.join(os.path.dirname(__file__), "config", "examples.json")
-        with open(examples_path, "r") as f:
-            examples_data = json.load(f)
-            
-        examples_text = "\n\n### SQL Few-Shot Examples:\n"
-        for ex in examples_data:
-            examples_text += f"User: {ex['question']}\nSQL: {ex['sql']}\n\n"
-            
-    except FileNotFoundError:
-        examples_text = ""
+    examples_text = config.examples_text()
 
     # 3. Add Orchestration and RAG-Specific Instructions
     orchestration_instruction = """
@@ -89,33 +68,19 @@ def load_config():
     
     return base_instructions + orchestration_instruction + examples_text
 
+def load_config():
+    """
+    Returns the orchestrator system prompt (cached until the config files change).
+    """
+    return config_registry.prompt("app_orchestrator", build_system_prompt)
+
 # --- TOOL 1: BIGQUERY (Text-to-SQL) ---
 def query_bigquery(query: str) -> dict:
     """
     Executes a Standard SQL query against the Resilitix BigQuery dataset.
     """
     print(f"DEBUG: Tool (BigQuery) called with: {query}")
-    payload = json.dumps({"query": query})
-    
-    try:
-        token = get_id_token(TOOL_URL)
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {token}'
-        }
-        
-        response = requests.post(TOOL_URL, data=payload, headers=headers)
-        
-        if response.status_code != 200:
-            return {"error": f"HTTP {response.status_code} Error. Raw response: {response.text}"}
-            
-        try:
-            return response.json()
-        except json.JSONDecodeError:
-            return {"error": f"Invalid JSON received. Raw content: {response.text}"}
-
-    except Exception as e:
-        return {"error": f"Connection Exception: {str(e)}"}
+    return get_sql_client().execute(query)
 
 # --- TOOL 2: RAG (Document Search) ---
 def search_knowledge_base(query: str) -> dict:
@@ -125,38 +90,9 @@ def search_knowledge_base(query: str) -> dict:
     print(f"DEBUG: Tool (RAG) called with: {query}")
     
     try:
-        # FIX: Explicitly set the client options to ensure the correct global endpoint is targeted
-        client_options = {"api_endpoint": "discoveryengine.googleapis.com"}
-        client = discoveryengine.SearchServiceClient(client_options=client_options)
-
-        serving_config = client.serving_config_path(
-            project=PROJECT_ID,
-            location="global", 
-            data_store=RAG_DATA_STORE_ID,
-            serving_config="default_search",
-        )
-        
-        # Configure Search Request to generate a summary
-        request = discoveryengine.SearchRequest(
-            serving_config=serving_config,
-            query=query,
-            page_size=5,
-            content_search_spec=discoveryengine.SearchRequest.ContentSearchSpec(
-                summary_spec=discoveryengine.SearchRequest.ContentSearchSpec.SummarySpec(
-                    summary_result_count=5 
-                )
-            )
-        )
-        response = client.search(request)
-        
-        # Extract the confirmed working summary field
-        summary_text = ""
-        if (response.summary and 
-            response.summary.summary_with_metadata and 
-            response.summary.summary_with_metadata.summary):
-            
-            summary_text = response.summary.summary_with_metadata.summary
-            
+        # Shared client (one gRPC channel per process) with a summary cache for repeated questions
+        summary_text = get_rag_client().search_summary(query)
+
         if not summary_text:
             return {"found": False, "message": "Search successful, but no relevant summary text could be generated from documents."}
             
@@ -168,50 +104,85 @@ def search_knowledge_base(query: str) -> dict:
         print(f"RAG Search Exception Detail: {e}")
         return {"error": f"RAG Search Exception: {str(e)}"}
 
-def plot_kepler_map(query: str) -> dict:
+# --- HELPER: MAP RENDERING ---
+def dataframe_fingerprint(df: pd.DataFrame) -> str:
     """
-    Queries BigQuery to retrieve geospatial data (hexID and value) 
-    and returns the data as a list of dictionaries, suitable for KeplerGL.
+    Content hash of a map dataset (columns + row values). Identical data gives the same
+    fingerprint, so the map HTML is only regenerated when the data actually changes.
+    """
+    digest = hashlib.sha1("|".join(map(str, df.columns)).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def render_map_html(fingerprint, _map_data) -> str:
+    """
+    Builds the Kepler HTML for a dataset. Cached by fingerprint (the DataFrame itself is not
+    hashed), so reruns reuse the same HTML string and the mounted iframe is left untouched.
+    """
+    if _map_data is not None:
+        map_ = KeplerGl(height=750, data={"resilience_layer": _map_data})
+    else:
+        # Empty Default Map
+        map_ = KeplerGl()
+    return map_._repr_html_(center_map=True)
+
+def plot_kepler_map(query: str):
+    """
+    Queries BigQuery to retrieve geospatial data (hexID and value) for the map.
+    Returns (result for the LLM, map DataFrame or None). It does not touch st.session_state,
+    so it can run on a tool worker thread; the caller stores the data.
     """
     print(f"\n[DEBUG] Generating SQL for KeplerGL data: {query}")
     
-    bigquery_result = query_bigquery(query)
+    # 1. Fetch the result as Arrow so the DataFrame keeps numeric dtypes
+    try:
+        df = get_sql_client().fetch_dataframe(query)
+    except Exception as e:
+        return {"error": f"Error retrieving data for map: {str(e)}"}, None
 
-    if "error" in bigquery_result:
-        return {"error": f"Error retrieving data for map: {bigquery_result['error']}"}
-
-    raw_data = bigquery_result.get("data", [])
-    
-    if not raw_data:
-        return {"error": "Query executed successfully but returned 0 records."}
+    if df.empty:
+        return {"error": "Query executed successfully but returned 0 records."}, None
 
     # 2. Process Data for Kepler
     try:
-        # Convert list of dicts to Pandas DataFrame
-        df = pd.DataFrame(raw_data)
-        
         # Validation: Ensure hex_id exists for mapping
         if 'hex_id' not in df.columns:
              # Try to find a column that looks like a hex_id if named differently
-            return {"error": "The SQL result must contain a column named 'hex_id' for the map to render."}
+            return {"error": "The SQL result must contain a column named 'hex_id' for the map to render."}, None
+
+        # 3. Level of detail: roll up to coarser hexes if the result exceeds the row budget
+        rows_retrieved = len(df)
+        df, lod_resolution = apply_lod(df)
 
-        # 3. Update Session State
-        # This stores the dataframe so the UI column can render it on the next run
-        st.session_state.map_data = df
-        
         # 4. Return Success Message to LLM
-        return {
+        result = {
             "status": "success",
-            "rows_retrieved": len(df),
+            "rows_retrieved": rows_retrieved,
             "message": "Data successfully loaded into the dashboard map. Tell the user the map has been updated."
         }
+        if lod_resolution is not None:
+            result["rows_plotted"] = len(df)
+            result["message"] += f" The data was aggregated to H3 resolution {lod_resolution} to keep the map responsive; mention this to the user."
+        return result, df
         
     except Exception as e:
-        return {"error": f"Data processing error: {str(e)}"}
+        return {"error": f"Data processing error: {str(e)}"}, None
 
-# --- 2. INITIALIZE SESSION STATE & TOOLS ---
-if "chat_session" not in st.session_state:
-    
+# Caption shown for each tool call, by function name
+TOOL_CAPTIONS = {
+    "query_bigquery": "🛠️ SQL: `{}`",
+    "search_knowledge_base": "📚 RAG: `{}`",
+    "plot_kepler_map": "🗺️ Plotting: `{}`",
+}
+
+# --- 2. REGISTER ORCHESTRATOR MODEL & TOOLS (once per process) ---
+@st.cache_resource
+def register_orchestrator():
+    """
+    Registers the orchestrator's tool schema and model. Runs once per server process;
+    every browser session then gets its own chat on the shared model.
+    """
     # --- TOOL 1: SQL Definition ---
     sql_func = FunctionDeclaration(
         name="query_bigquery",
@@ -260,18 +231,17 @@ if "chat_session" not in st.session_state:
         }
     )
     
-    combined_tools = Tool(
-        function_declarations=[sql_func, rag_func, plot_func]
+    return model_registry.register(
+        "app_orchestrator",
+        system_prompt=load_config,
+        functions=[sql_func, rag_func, plot_func],
     )
-    
-    full_system_instruction = load_config()
 
-    model = GenerativeModel(
-        "gemini-2.5-flash",
-        system_instruction=full_system_instruction, 
-        tools=[combined_tools],
-    )
-    st.session_state.chat_session = model.start_chat()
+register_orchestrator()
+
+# --- 3. INITIALIZE SESSION STATE ---
+if "chat_session" not in st.session_state:
+    st.session_state.chat_session = model_registry.start_chat("app_orchestrator")
     st.session_state.messages = []
 
 # --- LAYOUT DEFINITION ---
@@ -280,13 +250,8 @@ col1, col2, col3 = st.columns([3, 0.5, 6.5])
 # --- RIGHT COLUMN: MAP RENDERER ---
 with col3:
     try:
-        if st.session_state.map_data is not None:
-            map_ = KeplerGl(height=750, data={"resilience_layer": st.session_state.map_data})
-        else:
-            # Empty Default Map
-            map_ = KeplerGl()
-            
-        html_map = map_._repr_html_(center_map=True)
+        # Only rebuilt when the map data changes; chat reruns reuse the cached HTML
+        html_map = render_map_html(st.session_state.map_fingerprint, st.session_state.map_data)
         components.html(html_map, height=750)
     except Exception as e:
         st.error(f"Error rendering map: {e}")
@@ -310,54 +275,83 @@ with col1:
         with st.chat_message("assistant"):
             with st.spinner("Thinking..."):
                 try:
-                    # Send to Vertex AI
-                    response = st.session_state.chat_session.send_message(prompt)
-                    
-                    should_rerun = False # Flag to trigger UI update
+                    # Map data from plot_kepler_map by query. Tools may run on worker threads and finish
+                    # in any order, so the map to show is picked after the loop, in call order
+                    new_map_data = {}
+
+                    # Streamed answer text: one placeholder per model turn, created on its first token
+                    # so the answer renders below the tool captions
+                    stream = {"placeholder": None, "text": ""}
+
+                    def show_tokens(delta):
+                        if stream["placeholder"] is None:
+                            stream["placeholder"] = st.empty()
+                        stream["text"] += delta
+                        stream["placeholder"].markdown(stream["text"] + "▌")
+
+                    def show_tool_calls(calls):
+                        # Text streamed before a tool call was an intermediate thought, not the answer
+                        if stream["placeholder"] is not None:
+                            stream["placeholder"].empty()
+                        stream["placeholder"], stream["text"] = None, ""
+                        for fn in calls:
+                            st.caption(TOOL_CAPTIONS.get(fn.name, "🔧 {}").format(fn.args.get("query", "")))
+
+                    # Live progress (tool calls issued, rows returned, timings) in a collapsible
+                    # status panel, created on the first event so plain answers don't show one
+                    progress = {"status": None}
+
+                    def show_event(chunk):
+                        if progress["status"] is None:
+                            progress["status"] = st.status("Working...", expanded=False)
+                        progress["status"].write(format_event(chunk["event"]))
+
+                    def run_plot_kepler_map(args):
+                        result, map_data = plot_kepler_map(args.get("query", ""))
+                        if map_data is not None:
+                            new_map_data[args.get("query", "")] = map_data
+                        return result
 
                     # --- TOOL ORCHESTRATOR LOOP ---
-                    # We loop to handle potential multiple tool calls or chained reasoning
-                    while response.candidates[0].content.parts[0].function_call:
-                        
-                        part = response.candidates[0].content.parts[0]
-                        func_name = part.function_call.name
-                        args = part.function_call.args
-                        
-                        tool_result = None
-
-                        if func_name == "query_bigquery":
-                            sql_q = args.get("query", "")
-                            st.caption(f"🛠️ SQL: `{sql_q}`") 
-                            tool_result = query_bigquery(sql_q)
-                        
-                        elif func_name == "search_knowledge_base":
-                            rag_q = args.get("query", "")
-                            st.caption(f"📚 RAG: `{rag_q}`")
-                            tool_result = search_knowledge_base(rag_q)
-                        
-                        elif func_name == "plot_kepler_map":
-                            plot_q = args.get("query", "")
-                            st.caption(f"🗺️ Plotting: `{plot_q}`")
-                            tool_result = plot_kepler_map(plot_q)
-                            
-                            # CRITICAL: If plotting succeeded, we must rerun to update the Right Column
-                            if "status" in tool_result and tool_result["status"] == "success":
-                                should_rerun = True
-
-                        else:
-                            tool_result = {"error": f"Unknown function: {func_name}"}
-
-                        # Send Tool Response back to Gemini
-                        response = st.session_state.chat_session.send_message(
-                            Part.from_function_response(
-                                name=func_name,
-                                response={"content": tool_result}
-                            )
+                    # Bounded (turns, time, tokens); parallel calls from one response run concurrently.
+                    # On a budget stop the model is asked to answer with what it has, so the chat
+                    # session stays usable for the next prompt
+                    # Events are emitted on this thread, so the sink may touch Streamlit elements
+                    with event_sink(show_event), span("chat_turn"):
+                        loop = run_tool_loop(
+                            st.session_state.chat_session,
+                            prompt,
+                            {
+                                "query_bigquery": lambda args: query_bigquery(args.get("query", "")),
+                                "search_knowledge_base": lambda args: search_knowledge_base(args.get("query", "")),
+                                "plot_kepler_map": run_plot_kepler_map,
+                            },
+                            name="Orchestrator",
+                            wrap_up=True,
+                            on_calls=show_tool_calls,
+                            on_text=show_tokens,
                         )
+                    if progress["status"] is not None:
+                        progress["status"].update(
+                            label=f"Done in {loop.elapsed_s:.1f}s ({sum(len(t.tools) for t in loop.turns)} tool calls)",
+                            state="complete" if loop.stop_reason == "done" else "error",
+                        )
+
+                    # CRITICAL: If plotting succeeded, we must rerun to update the Right Column.
+                    # The map shown is the last successful plot the model issued, not the last to finish
+                    plotted = [
+                        new_map_data[call.args.get("query", "")] for call in loop.calls
+                        if call.name == "plot_kepler_map" and call.args.get("query", "") in new_map_data
+                    ]
+                    should_rerun = bool(plotted)
+                    if should_rerun:
+                        st.session_state.map_data = plotted[-1]
+                        st.session_state.map_fingerprint = dataframe_fingerprint(plotted[-1])
 
                     # Display Final Text
-                    final_text = response.text
-                    st.markdown(final_text)
+                    final_text = loop.text or "I couldn't complete that request within the tool budget."
+                    st.caption(f"⏱️ {len(loop.turns)} turns · LLM {loop.llm_s:.1f}s · tools {loop.tool_s:.1f}s")
+                    (stream["placeholder"] or st.empty()).markdown(final_text)
                     st.session_state.messages.append({"role": "assistant", "content": final_text})
 
                     # Trigger the map update if needed
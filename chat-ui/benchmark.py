@@ -0,0 +1,333 @@
+"""
+Offline benchmark for the multi-agent graph (graph.py).
+
+Gemini, the SQL tool and Vertex AI Search are replaced by local stand-ins with
+injected latencies, so the graph's own overhead (routing, fan-out / fan-in,
+tool loops, streaming, state merging) can be measured on a laptop with no
+network:
+
+- FakeChat answers each specialist from a script: one function call (run_sql,
+  search_knowledge_base, run_map_sql), then text. The summarizer streams its
+  answer in chunks.
+- The SQL tool returns BENCH_SQL_ROWS synthetic rows, the RAG search a canned
+  summary.
+- The semantic cache is disabled (it needs the embedding API).
+
+Runs BENCH_SESSIONS sessions, BENCH_CONCURRENCY at a time, on the async app
+(BENCH_MODE=async) or the blocking app in worker threads (BENCH_MODE=sync), and
+reports p50/p95/p99 end-to-end latency, time to first summary token, per-node
+time and throughput. Per-node times come from the graph's progress events
+(events.py).
+
+    BENCH_SESSIONS=200 BENCH_CONCURRENCY=20 python benchmark.py
+"""
+
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+from langchain_core.messages import HumanMessage
+
+import graph
+
+# --- CONFIGURATION ---
+BENCH_MODE = os.environ.get("BENCH_MODE", "async")  # async | sync
+BENCH_SESSIONS = int(os.environ.get("BENCH_SESSIONS", "50"))
+BENCH_CONCURRENCY = int(os.environ.get("BENCH_CONCURRENCY", "10"))
+# Injected latencies (seconds); each sample is scaled by a random factor in [1 - jitter, 1 + jitter]
+BENCH_LLM_LATENCY_S = float(os.environ.get("BENCH_LLM_LATENCY_S", "0.8"))
+BENCH_SQL_LATENCY_S = float(os.environ.get("BENCH_SQL_LATENCY_S", "1.5"))
+BENCH_RAG_LATENCY_S = float(os.environ.get("BENCH_RAG_LATENCY_S", "0.6"))
+BENCH_JITTER = float(os.environ.get("BENCH_JITTER", "0.3"))
+BENCH_SQL_ROWS = int(os.environ.get("BENCH_SQL_ROWS", "200"))
+# The summarizer's text arrives in this many streamed chunks
+BENCH_STREAM_CHUNKS = int(os.environ.get("BENCH_STREAM_CHUNKS", "20"))
+BENCH_SEED = int(os.environ.get("BENCH_SEED", "7"))
+# Write the report as JSON here as well (e.g. to diff against an earlier run)
+BENCH_OUTPUT = os.environ.get("BENCH_OUTPUT", "")
+BENCH_VERBOSE = os.environ.get("BENCH_VERBOSE", "0") == "1"
+
+# Plot and non-plot questions, so both graph routes are exercised
+BENCH_QUERIES = [
+    "show me the hospitals in the high flood risk areas in brazos county",
+    "plot the population by county in texas on a map",
+    "what is the average flood risk score in harris county",
+    "how many schools are in travis county and what does the report say about their resilience",
+]
+
+_rng = random.Random(BENCH_SEED)
+_rng_lock = threading.Lock()
+
+def latency(base: float) -> float:
+    with _rng_lock:
+        return max(0.0, base * _rng.uniform(1 - BENCH_JITTER, 1 + BENCH_JITTER))
+
+# --- FAKE GEMINI ---
+
+def text_part(text: str):
+    return SimpleNamespace(text=text, function_call=None)
+
+def call_part(name: str, args: Dict[str, Any]):
+    return SimpleNamespace(text="", function_call=SimpleNamespace(name=name, args=args))
+
+class FakeResponse:
+    """Shaped like a GenerationResponse: candidates[0].content.parts, usage_metadata, text."""
+
+    def __init__(self, parts, tokens: int):
+        self.candidates = [SimpleNamespace(content=SimpleNamespace(role="model", parts=parts))]
+        self.usage_metadata = SimpleNamespace(total_token_count=tokens)
+
+    @property
+    def text(self) -> str:
+        return "".join(p.text for p in self.candidates[0].content.parts)
+
+SUMMARY_TEXT = (
+    "Brazos County has 4 hospitals inside high flood risk hexes. Two of them sit in the 100-year "
+    "floodplain and the knowledge base recommends elevating backup power for both. "
+) * 3
+
+# Specialist -> scripted turns (function calls first, then the final text)
+SCRIPTS = {
+    "sql_agent": [
+        [call_part("run_sql", {"query": "SELECT hex_id, value FROM bench_results LIMIT 200"})],
+        [text_part('{"status": "success"}')],
+    ],
+    "rag_agent": [
+        [call_part("search_knowledge_base", {"query": "flood risk hospitals"})],
+        [text_part("Hospitals in floodplains should elevate backup power.")],
+    ],
+    "mapping_agent": [
+        [call_part("run_map_sql", {"query": "SELECT hex_id, value FROM bench_map LIMIT 200"})],
+        [text_part('{"status": "success"}')],
+    ],
+    "summarize_agent": [
+        [text_part(SUMMARY_TEXT)],
+    ],
+}
+
+class FakeChat:
+    """ChatSession stand-in that plays a specialist's script with injected LLM latency."""
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.history = []
+
+    def _next(self, message) -> FakeResponse:
+        self.history.append(SimpleNamespace(role="user", parts=message))
+        parts = self.script.pop(0) if self.script else [text_part("Done.")]
+        response = FakeResponse(parts, tokens=500 + len(json.dumps(str(message))) // 4)
+        self.history.append(response.candidates[0].content)
+        return response
+
+    @staticmethod
+    def _chunks(response: FakeResponse) -> List[FakeResponse]:
+        text = response.text
+        size = max(1, len(text) // BENCH_STREAM_CHUNKS)
+        if not text:
+            return [response]
+        return [FakeResponse([text_part(text[i:i + size])], tokens=0) for i in range(0, len(text), size)]
+
+    def _stream(self, response: FakeResponse, first_token_s: float):
+        chunks = self._chunks(response)
+        time.sleep(first_token_s)
+        for chunk in chunks:
+            yield chunk
+            time.sleep(first_token_s / len(chunks))
+
+    async def _stream_async(self, response: FakeResponse, first_token_s: float):
+        chunks = self._chunks(response)
+        await asyncio.sleep(first_token_s)
+        for chunk in chunks:
+            yield chunk
+            await asyncio.sleep(first_token_s / len(chunks))
+
+    def send_message(self, message, stream: bool = False, **kwargs):
+        response = self._next(message)
+        if stream:
+            # Half the latency before the first token, the rest spread over the chunks
+            return self._stream(response, latency(BENCH_LLM_LATENCY_S) / 2)
+        time.sleep(latency(BENCH_LLM_LATENCY_S))
+        return response
+
+    async def send_message_async(self, message, stream: bool = False, **kwargs):
+        response = self._next(message)
+        if stream:
+            return self._stream_async(response, latency(BENCH_LLM_LATENCY_S) / 2)
+        await asyncio.sleep(latency(BENCH_LLM_LATENCY_S))
+        return response
+
+class FakeModelRegistry:
+    """Stands in for model_registry: every session plays its specialist's script."""
+
+    def start_chat(self, name: str, history=None) -> FakeChat:
+        return FakeChat(SCRIPTS.get(name, []))
+
+# --- FAKE BACKENDS ---
+
+def fake_rows(n: int = BENCH_SQL_ROWS) -> List[Dict[str, Any]]:
+    return [{"hex_id": f"86489e3{i:08x}", "value": i % 97} for i in range(n)]
+
+def fake_sql(query: str) -> Dict[str, Any]:
+    time.sleep(latency(BENCH_SQL_LATENCY_S))
+    return {"data": fake_rows()}
+
+async def fake_sql_async(query: str) -> Dict[str, Any]:
+    await asyncio.sleep(latency(BENCH_SQL_LATENCY_S))
+    return {"data": fake_rows()}
+
+RAG_RESULT = {"summary": "Critical facilities in floodplains should elevate backup power.", "found": True}
+
+def fake_rag(query: str) -> Dict[str, Any]:
+    time.sleep(latency(BENCH_RAG_LATENCY_S))
+    return dict(RAG_RESULT)
+
+async def fake_rag_async(query: str) -> Dict[str, Any]:
+    await asyncio.sleep(latency(BENCH_RAG_LATENCY_S))
+    return dict(RAG_RESULT)
+
+def install_fakes():
+    """Points graph.py at the local stand-ins (names are looked up in graph's globals at call time)."""
+    graph.model_registry = FakeModelRegistry()
+    graph.execute_checked_bigquery_request = fake_sql
+    graph.execute_checked_bigquery_request_async = fake_sql_async
+    graph.execute_rag_search = fake_rag
+    graph.execute_rag_search_async = fake_rag_async
+    graph.get_semantic_cache = lambda: None
+
+# --- SESSIONS ---
+
+def initial_input(query: str) -> Dict[str, Any]:
+    return {"task": query, "messages": [HumanMessage(content=query)], "results": []}
+
+class SessionStats:
+    """What one session measured: end-to-end time, first summary token and per-node times."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.elapsed_s = 0.0
+        self.first_token_s: Optional[float] = None
+        self.nodes: Dict[str, float] = {}
+        self.error: Optional[str] = None
+
+    def observe(self, chunk: Dict[str, Any]):
+        if "summary_token" in chunk and self.first_token_s is None:
+            self.first_token_s = time.perf_counter() - self.started
+        event = chunk.get("event")
+        if event and event["type"] == "node_end":
+            self.nodes[event["node"]] = self.nodes.get(event["node"], 0.0) + event["elapsed_s"]
+
+    def done(self):
+        self.elapsed_s = time.perf_counter() - self.started
+
+def run_session(query: str) -> SessionStats:
+    stats = SessionStats()
+    try:
+        for chunk in graph.app.stream(initial_input(query), stream_mode="custom"):
+            stats.observe(chunk)
+    except Exception as e:
+        stats.error = str(e)
+    stats.done()
+    return stats
+
+async def run_session_async(query: str, slots: asyncio.Semaphore) -> SessionStats:
+    async with slots:
+        stats = SessionStats()
+        try:
+            async for chunk in graph.async_app.astream(initial_input(query), stream_mode="custom"):
+                stats.observe(chunk)
+        except Exception as e:
+            stats.error = str(e)
+        stats.done()
+        return stats
+
+async def run_all_async(queries: List[str], concurrency: int) -> List[SessionStats]:
+    slots = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(*(run_session_async(q, slots) for q in queries))
+
+def run_all(queries: List[str], concurrency: int) -> List[SessionStats]:
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(run_session, queries))
+
+# --- REPORT ---
+
+def percentile(values: List[float], q: float) -> float:
+    """q-th percentile (0-100) with linear interpolation."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def distribution(values: List[float]) -> Dict[str, float]:
+    return {
+        "mean": round(statistics.fmean(values), 4) if values else 0.0,
+        "p50": round(percentile(values, 50), 4),
+        "p95": round(percentile(values, 95), 4),
+        "p99": round(percentile(values, 99), 4),
+    }
+
+def build_report(sessions: List[SessionStats], wall_s: float) -> Dict[str, Any]:
+    ok = [s for s in sessions if s.error is None]
+    node_names = sorted({n for s in ok for n in s.nodes})
+    return {
+        "config": {
+            "mode": BENCH_MODE, "sessions": len(sessions), "concurrency": BENCH_CONCURRENCY,
+            "llm_latency_s": BENCH_LLM_LATENCY_S, "sql_latency_s": BENCH_SQL_LATENCY_S,
+            "rag_latency_s": BENCH_RAG_LATENCY_S, "jitter": BENCH_JITTER, "sql_rows": BENCH_SQL_ROWS,
+        },
+        "errors": len(sessions) - len(ok),
+        "wall_s": round(wall_s, 3),
+        "throughput_sessions_per_s": round(len(ok) / wall_s, 3) if wall_s else 0.0,
+        "end_to_end_s": distribution([s.elapsed_s for s in ok]),
+        "first_token_s": distribution([s.first_token_s for s in ok if s.first_token_s is not None]),
+        "nodes_s": {n: distribution([s.nodes[n] for s in ok if n in s.nodes]) for n in node_names},
+    }
+
+def print_report(report: Dict[str, Any]):
+    config = report["config"]
+    print(f"\n{'='*20} GRAPH BENCHMARK ({config['mode']}) {'='*20}")
+    print(f"Sessions: {config['sessions']} (concurrency {config['concurrency']}), errors: {report['errors']}")
+    print(f"Wall time: {report['wall_s']:.2f}s, throughput: {report['throughput_sessions_per_s']:.2f} sessions/s")
+    print(f"\n{'':<20}{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}")
+    rows = [("end-to-end", report["end_to_end_s"]), ("first token", report["first_token_s"])]
+    rows += [(f"  {name}", dist) for name, dist in report["nodes_s"].items()]
+    for label, dist in rows:
+        print(f"{label:<20}" + "".join(f"{dist[k]:>8.3f}s" for k in ("mean", "p50", "p95", "p99")))
+
+def main():
+    install_fakes()
+    queries = [BENCH_QUERIES[i % len(BENCH_QUERIES)] for i in range(BENCH_SESSIONS)]
+
+    # The agents log every step; keep the report readable unless asked otherwise
+    quiet = contextlib.nullcontext() if BENCH_VERBOSE else contextlib.redirect_stdout(io.StringIO())
+    started = time.perf_counter()
+    with quiet:
+        if BENCH_MODE == "sync":
+            sessions = run_all(queries, BENCH_CONCURRENCY)
+        else:
+            sessions = asyncio.run(run_all_async(queries, BENCH_CONCURRENCY))
+    report = build_report(sessions, time.perf_counter() - started)
+
+    print_report(report)
+    for s in sessions:
+        if s.error:
+            print(f"First error: {s.error}")
+            break
+    if BENCH_OUTPUT:
+        with open(BENCH_OUTPUT, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport written to {BENCH_OUTPUT}")
+
+if __name__ == "__main__":
+    main()
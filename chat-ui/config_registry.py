@@ -0,0 +1,98 @@
+"""
+Cached loading of the prompt configuration in config/.
+
+instructions.md and examples.json are read once and every system prompt built
+from them is memoized. The cache is dropped only when one of the files'
+mtimes changes, so edits still show up without a restart.
+"""
+
+import json
+import os
+import threading
+from typing import Callable, Dict, Optional
+
+CONFIG_DIR = os.path.join(os.path.dirname(__file__), "config")
+INSTRUCTIONS_FILE = "instructions.md"
+EXAMPLES_FILE = "examples.json"
+
+class ConfigRegistry:
+    """Builds each system prompt once and reloads only when the config files change."""
+
+    def __init__(self, config_dir: str = CONFIG_DIR):
+        self.config_dir = config_dir
+        self._lock = threading.RLock()
+        self._mtimes = None
+        self._instructions = None
+        self._examples = None
+        self._prompts: Dict[str, str] = {}
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.config_dir, name)
+
+    def _current_mtimes(self):
+        mtimes = []
+        for name in (INSTRUCTIONS_FILE, EXAMPLES_FILE):
+            try:
+                mtimes.append(os.stat(self._path(name)).st_mtime_ns)
+            except FileNotFoundError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def _refresh(self):
+        """Re-reads the files and drops built prompts if any mtime changed."""
+        mtimes = self._current_mtimes()
+        if mtimes == self._mtimes:
+            return
+
+        # 1. Load Rules
+        try:
+            with open(self._path(INSTRUCTIONS_FILE), "r") as f:
+                self._instructions = f.read()
+        except FileNotFoundError:
+            self._instructions = None
+
+        # 2. Load Examples
+        try:
+            with open(self._path(EXAMPLES_FILE), "r") as f:
+                examples_data = json.load(f)
+            self._examples = "\n\n### SQL Few-Shot Examples:\n" + "".join(
+                f"User: {ex['question']}\nSQL: {ex['sql']}\n\n" for ex in examples_data
+            )
+        except FileNotFoundError:
+            self._examples = ""
+
+        self._prompts = {}
+        self._mtimes = mtimes
+
+    def instructions(self, default: str = "You are a helpful data assistant.") -> str:
+        """Contents of instructions.md, or `default` if the file is missing."""
+        with self._lock:
+            self._refresh()
+            return self._instructions if self._instructions is not None else default
+
+    def examples_text(self) -> str:
+        """The few-shot section built from examples.json ("" if the file is missing)."""
+        with self._lock:
+            self._refresh()
+            return self._examples
+
+    def prompt(self, name: str, build: Callable[["ConfigRegistry"], str]) -> str:
+        """Returns the prompt registered under `name`, building it on first use or after a file change."""
+        with self._lock:
+            self._refresh()
+            if name not in self._prompts:
+                self._prompts[name] = build(self)
+            return self._prompts[name]
+
+    def version(self) -> Optional[tuple]:
+        """Opaque token that changes whenever the config files change."""
+        with self._lock:
+            self._refresh()
+            return self._mtimes
+
+# Process-wide registry shared by app.py, graph.py and test_agents.py
+registry = ConfigRegistry()
+
+def load_config() -> str:
+    """Instructions plus SQL few-shot examples (the shared schema context for the agents)."""
+    return registry.prompt("shared_context", lambda r: r.instructions() + "\n" + r.examples_text())
@@ -0,0 +1,231 @@
+"""
+Local, memory-mapped index of data_library.hex_county_state_zip_crosswalk.
+
+Built once straight from BigQuery (`python crosswalk_index.py`) into a
+directory of .npy arrays plus a small JSON catalog, then opened with mmap by
+the chat-ui. County mentions in a question resolve in-process to the exact
+County / State spelling and hex set, which the SQL agent is told before it
+writes SQL (geography_hint). The agent's queries still run on BigQuery.
+
+Offline checks: python -m doctest crosswalk_index.py
+
+Layout (rows sorted by state, county):
+    hex_ids.npy, hex_l7.npy, hex_l6.npy   uint64 H3 ids
+    zip_order.npy                         uint32 row numbers sorted by zipcode
+    catalog.json                          county/state row ranges, zip ranges
+"""
+
+import json
+import os
+import re
+import threading
+from typing import Dict, List, Optional
+
+import h3
+import numpy as np
+
+CROSSWALK_INDEX_DIR = os.environ.get(
+    "CROSSWALK_INDEX_DIR", os.path.join(os.path.dirname(__file__), "data", "crosswalk_index")
+)
+# Hex sets up to this size are handed to the SQL agent inline
+CROSSWALK_INLINE_LIMIT = int(os.environ.get("CROSSWALK_INLINE_LIMIT", "200"))
+
+# Project the build script reads the crosswalk from
+CROSSWALK_PROJECT_ID = os.environ.get("CROSSWALK_PROJECT_ID", "resiliencegenomeai")
+
+CROSSWALK_QUERY = """
+SELECT hex_id, County, State, Zipcode, hex_id_l7, hex_id_l6
+FROM data_library.hex_county_state_zip_crosswalk
+"""
+
+_COUNTY_MENTION_RE = re.compile(r"([A-Za-z][A-Za-z .'-]*?)\s+(?:county|parish)\b", re.IGNORECASE)
+# Words that can precede "county" without being part of a name ("for a county", "each county")
+_NOT_COUNTY_WORDS = {
+    "A", "AN", "THE", "IN", "OF", "FOR", "AND", "OR", "EACH", "EVERY", "PER", "BY", "WHICH", "WHAT", "THIS",
+    "THAT", "MY", "OUR", "TO", "FROM", "ACROSS", "WITHIN", "NEAR", "ANY", "SAME", "ONE",
+}
+
+def _county_key(name: str) -> str:
+    """Comparison form of a county name: upper case, without a trailing "County" / "Parish"."""
+    return re.sub(r"\s+(?:COUNTY|PARISH)$", "", name.strip().upper())
+
+def _to_uint64(hex_strings) -> np.ndarray:
+    return np.fromiter(
+        (h3.str_to_int(h) if h else 0 for h in hex_strings), dtype="<u8", count=len(hex_strings)
+    )
+
+def build_crosswalk_index(df, out_dir: str = CROSSWALK_INDEX_DIR):
+    """Writes the index for a crosswalk DataFrame (columns as in CROSSWALK_QUERY)."""
+    os.makedirs(out_dir, exist_ok=True)
+    df = df.fillna({"County": "", "State": "", "Zipcode": ""})
+    df = df.sort_values(["State", "County"], kind="stable").reset_index(drop=True)
+
+    np.save(os.path.join(out_dir, "hex_ids.npy"), _to_uint64(df["hex_id"].tolist()))
+    np.save(os.path.join(out_dir, "hex_l7.npy"), _to_uint64(df["hex_id_l7"].fillna("").tolist()))
+    np.save(os.path.join(out_dir, "hex_l6.npy"), _to_uint64(df["hex_id_l6"].fillna("").tolist()))
+
+    counties = []
+    for (state, county), rows in df.groupby(["State", "County"], sort=False).indices.items():
+        counties.append({"state": state, "county": county, "start": int(rows.min()), "end": int(rows.max()) + 1})
+
+    zip_order = np.argsort(df["Zipcode"].to_numpy(dtype=str), kind="stable").astype("<u4")
+    np.save(os.path.join(out_dir, "zip_order.npy"), zip_order)
+    sorted_zips = df["Zipcode"].to_numpy(dtype=str)[zip_order]
+    zips = {}
+    boundaries = np.flatnonzero(sorted_zips[1:] != sorted_zips[:-1]) + 1
+    for start, end in zip(np.r_[0, boundaries], np.r_[boundaries, len(sorted_zips)]):
+        zips[str(sorted_zips[start])] = [int(start), int(end)]
+
+    with open(os.path.join(out_dir, "catalog.json"), "w") as f:
+        json.dump({"rows": len(df), "counties": counties, "zips": zips}, f)
+
+    print(f"Crosswalk index written to {out_dir}: {len(df)} hexes, {len(counties)} counties, {len(zips)} zips")
+
+class CrosswalkIndex:
+    """
+    Read-only, memory-mapped view of the crosswalk index.
+
+    County names match exactly, not by prefix, and a state mentioned in the question only
+    narrows the counties it has:
+
+    >>> import tempfile, pandas as pd
+    >>> cells = [h3.latlng_to_cell(30.0, -95.0 - i, 8) for i in range(4)]
+    >>> index_dir = tempfile.mkdtemp()
+    >>> build_crosswalk_index(pd.DataFrame({
+    ...     "hex_id": cells, "County": ["Harris", "Harrison", "Fort Bend", "Washington"],
+    ...     "State": ["Texas", "Texas", "Texas", "Arkansas"], "Zipcode": ["77002", "75670", "77469", "72701"],
+    ...     "hex_id_l7": [h3.cell_to_parent(c, 7) for c in cells],
+    ...     "hex_id_l6": [h3.cell_to_parent(c, 6) for c in cells],
+    ... }), index_dir)  # doctest: +ELLIPSIS
+    Crosswalk index written to ...: 4 hexes, 4 counties, 4 zips
+    >>> index = CrosswalkIndex(index_dir)
+    >>> index.count(county="Harris"), index.count(county="Harris County"), index.count(county="Harr")
+    (1, 1, 0)
+    >>> index.resolve_mentions("flood risk in Harris County")
+    [{'county': 'Harris', 'state': 'Texas'}]
+    >>> index.resolve_mentions("hospitals for a county")
+    []
+    >>> index.resolve_mentions("fort bend county and washington county in arkansas")
+    [{'county': 'Fort Bend', 'state': 'Texas'}, {'county': 'Washington', 'state': 'Arkansas'}]
+    """
+
+    LEVEL_ARRAYS = {None: "hex_ids", 7: "hex_l7", 6: "hex_l6"}
+
+    def __init__(self, index_dir: str = CROSSWALK_INDEX_DIR):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, "catalog.json"), "r") as f:
+            catalog = json.load(f)
+        self.counties = catalog["counties"]
+        self.zips = catalog["zips"]
+        self.states = sorted({c["state"] for c in self.counties if c["state"]})
+        self._arrays = {
+            name: np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="r")
+            for name in ("hex_ids", "hex_l7", "hex_l6", "zip_order")
+        }
+
+    def _rows(self, state: Optional[str] = None, county: Optional[str] = None,
+              zipcode: Optional[str] = None) -> np.ndarray:
+        """Row numbers matching all given filters. County names match exactly ("Harris" is not "Harrison")."""
+        selected = None
+        if state or county:
+            ranges = [
+                np.arange(c["start"], c["end"]) for c in self.counties
+                if (not state or c["state"].upper() == state.upper())
+                and (not county or _county_key(c["county"]) == _county_key(county))
+            ]
+            selected = np.concatenate(ranges) if ranges else np.empty(0, dtype=np.int64)
+        if zipcode:
+            start, end = self.zips.get(str(zipcode), (0, 0))
+            zip_rows = np.asarray(self._arrays["zip_order"][start:end], dtype=np.int64)
+            selected = zip_rows if selected is None else np.intersect1d(selected, zip_rows)
+        return selected if selected is not None else np.empty(0, dtype=np.int64)
+
+    def hex_ids(self, state: Optional[str] = None, county: Optional[str] = None,
+                zipcode: Optional[str] = None, level: Optional[int] = None) -> np.ndarray:
+        """Unique uint64 H3 ids for a location, at the crosswalk's base level or its l7 / l6 parents."""
+        values = self._arrays[self.LEVEL_ARRAYS[level]][self._rows(state, county, zipcode)]
+        return np.unique(values[values != 0])
+
+    def hex_strings(self, *args, **kwargs) -> List[str]:
+        return [h3.int_to_str(int(h)) for h in self.hex_ids(*args, **kwargs)]
+
+    def count(self, *args, **kwargs) -> int:
+        return int(len(self.hex_ids(*args, **kwargs)))
+
+    def resolve_mentions(self, text: str) -> List[Dict[str, str]]:
+        """
+        Finds "<Name> County" mentions (optionally with a state name) in free text and maps them
+        to the exact County / State spellings in the crosswalk.
+        """
+        # Whole words only, so "Kansas" does not match inside "Arkansas"
+        mentioned_states = [s for s in self.states if re.search(rf"\b{re.escape(s)}\b", text, re.IGNORECASE)]
+
+        matches = []
+        for m in _COUNTY_MENTION_RE.finditer(text):
+            words = m.group(1).split()
+            # Try the longest trailing phrase first ("fort bend", then "bend"); a phrase starting
+            # with a filler or one-letter word ("for a", "a") is not a county name
+            for i in range(len(words)):
+                if words[i].upper() in _NOT_COUNTY_WORDS or len(words[i]) < 2:
+                    continue
+                name = _county_key(" ".join(words[i:]))
+                found = [c for c in self.counties if _county_key(c["county"]) == name]
+                # A state named anywhere narrows ambiguous names ("Washington County, Arkansas"),
+                # but must not drop a county that only exists elsewhere ("Fort Bend County and ...")
+                in_states = [c for c in found if c["state"] in mentioned_states]
+                found = in_states or found
+                if found:
+                    for c in found:
+                        match = {"county": c["county"], "state": c["state"]}
+                        if match not in matches:
+                            matches.append(match)
+                    break
+        return matches
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_index() -> Optional[CrosswalkIndex]:
+    """Shared index, loaded on first use. None if the index has not been built."""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None and os.path.exists(os.path.join(CROSSWALK_INDEX_DIR, "catalog.json")):
+                _index = CrosswalkIndex()
+    return _index
+
+def geography_hint(user_query: str) -> str:
+    """
+    Text block for the SQL agent describing the locations resolved locally for this question:
+    exact County/State spellings, hex counts and, for small areas, the explicit hex ids.
+    Empty when the index is unavailable or nothing was recognised.
+    """
+    index = get_index()
+    if index is None:
+        return ""
+
+    lines = []
+    for match in index.resolve_mentions(user_query):
+        hexes = index.hex_strings(state=match["state"], county=match["county"])
+        line = f"- County = '{match['county']}', State = '{match['state']}': {len(hexes)} hexes"
+        if 0 < len(hexes) <= CROSSWALK_INLINE_LIMIT:
+            line += f" (hex_id IN ({', '.join(repr(h) for h in hexes)}))"
+        lines.append(line)
+
+    if not lines:
+        return ""
+    return "Resolved geography (from the local crosswalk index):\n" + "\n".join(lines)
+
+def fetch_crosswalk():
+    """
+    The whole crosswalk as a DataFrame, read with a direct BigQuery client: a national
+    crosswalk is too large for one (buffered) SQL tool response.
+    """
+    from google.cloud import bigquery
+
+    client = bigquery.Client(project=CROSSWALK_PROJECT_ID)
+    return client.query(CROSSWALK_QUERY).result().to_arrow().to_pandas()
+
+if __name__ == "__main__":
+    # Build (or rebuild) the index from BigQuery
+    build_crosswalk_index(fetch_crosswalk())
@@ -0,0 +1,93 @@
+"""
+Structured progress events for the agents.
+
+Code emits events (node start/end, tool call issued, tool result with rows and
+elapsed time) with `emit`; whoever is running the request decides where they go
+by installing a sink for the current context:
+
+- graph.py nodes install LangGraph's StreamWriter, so events reach
+  stream_mode="custom" consumers as {"event": {...}},
+- app.py installs a callback that writes into an st.status panel.
+
+The sink lives in a ContextVar, so concurrent sessions don't see each other's
+events. Nothing is emitted when no sink is installed.
+"""
+
+import contextvars
+import inspect
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional
+
+_sink: contextvars.ContextVar[Optional[Callable[[Dict[str, Any]], None]]] = contextvars.ContextVar(
+    "agent_event_sink", default=None
+)
+
+def emit(event_type: str, node: str, **detail):
+    """Sends one event to the current sink, if any."""
+    sink = _sink.get()
+    if sink is None:
+        return
+    try:
+        sink({"event": {"type": event_type, "node": node, "ts": time.time(), **detail}})
+    except Exception as e:
+        # Progress reporting must never break the request
+        print(f"    [Events] Sink failed: {e}")
+
+@contextmanager
+def event_sink(sink: Callable[[Dict[str, Any]], None]):
+    """Routes events emitted in this context (and contexts copied from it) to `sink`."""
+    token = _sink.set(sink)
+    try:
+        yield
+    finally:
+        _sink.reset(token)
+
+def result_rows(result) -> Optional[int]:
+    """Row count of a tool result shaped like {"data": [...]}, else None."""
+    if isinstance(result, dict) and isinstance(result.get("data"), list):
+        return len(result["data"])
+    return None
+
+def format_event(event: Dict[str, Any]) -> str:
+    """One-line, human readable form of an event (for logs and status panels)."""
+    kind, node = event["type"], event["node"]
+    if kind == "node_start":
+        return f"▶️ {node} started"
+    if kind == "node_end":
+        return f"✅ {node} finished in {event['elapsed_s']:.1f}s"
+    if kind == "tool_call":
+        return f"🛠️ {node}: calling {event['tool']}"
+    if kind == "tool_result":
+        outcome = "error" if event.get("error") else (
+            f"{event['rows']} rows" if event.get("rows") is not None else "done"
+        )
+        return f"📦 {node}: {event['tool']} → {outcome} in {event['elapsed_s']:.1f}s"
+    return f"{kind} ({node})"
+
+def instrument_node(name: str, node: Callable) -> Callable:
+    """
+    Wraps a graph node so it emits node_start / node_end (with elapsed time) through the
+    run's StreamWriter. The writer is also passed on to nodes that take one.
+    """
+    wants_writer = "writer" in inspect.signature(node).parameters
+
+    # No functools.wraps: LangGraph reads the wrapper's own signature to inject `writer`
+    if inspect.iscoroutinefunction(node):
+        async def async_wrapper(state, writer):
+            with event_sink(writer):
+                started = time.perf_counter()
+                emit("node_start", name)
+                update = await (node(state, writer) if wants_writer else node(state))
+                emit("node_end", name, elapsed_s=time.perf_counter() - started)
+                return update
+        return async_wrapper
+
+    def wrapper(state, writer):
+        with event_sink(writer):
+            started = time.perf_counter()
+            emit("node_start", name)
+            update = node(state, writer) if wants_writer else node(state)
+            emit("node_end", name, elapsed_s=time.perf_counter() - started)
+            return update
+    return wrapper
@@ -1,16 +1,14 @@
 import vertexai
 from vertexai.generative_models import GenerativeModel, Tool, Part, Content, ChatSession, FunctionDeclaration
-import requests
+import asyncio
 import json
-import google.auth.transport.requests
-import google.oauth2.id_token
+import operator
 import os
 import traceback
 from pydantic import BaseModel
-from google.cloud import discoveryengine_v1 as discoveryengine
 from typing import Dict, Any, Literal, TypedDict, Annotated, Sequence, Optional, Union
 from langchain_core.runnables import Runnable
-from langgraph.types import Command
+from langgraph.types import Command, StreamWriter
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, AIMessageChunk, SystemMessage
 from langchain.agents import create_agent
 from langgraph.graph.state import CompiledStateGraph
@@ -18,206 +16,223 @@ from langgraph.checkpoint.memory import InMemorySaver
 from langgraph.store.memory import InMemoryStore
 from langgraph.graph import END, START, StateGraph
 from langgraph.graph.message import add_messages
+from config_registry import load_config, registry as config_registry
+from model_registry import registry as model_registry
+from sql_client import execute_checked_bigquery_request, execute_checked_bigquery_request_async
+from rag_client import execute_rag_search, execute_rag_search_async
+from crosswalk_index import geography_hint
+from events import format_event, instrument_node
+from tracing import traced
+from tool_loop import run_tool_loop, run_tool_loop_async, stream_turn, stream_turn_async
+from sql_validator import validation_error
+from semantic_cache import get_cache as get_semantic_cache
 
 # Config
 
 PROJECT_ID = "resiliencegenomeai"
 LOCATION = "us-central1"
-TOOL_URL = "https://resilitix-sql-tool-525917099044.us-central1.run.app"
-RAG_DATA_STORE_ID = "resilitix-rag-data_1765252053186" 
 
 vertexai.init(project=PROJECT_ID, location=LOCATION)
 
 # Helper methods
 
-def get_id_token(url: str) -> str:
-    """Generates a Google ID Token to authenticate with the Cloud Run tool."""
-    auth_req = google.auth.transport.requests.Request()
-    return google.oauth2.id_token.fetch_id_token(auth_req, url)
-
-def load_config():
-    """Reads instructions.md and examples.json to build the context string."""
-    # 1. Load Rules
-    try:
-        config_path = os.path.join(os.path.dirname(__file__), "config", "instructions.md")
-        with open(config_path, "r") as f:
-            base_instructions = f.read()
-    except FileNotFoundError:
-        base_instructions = "You are a helpful data assistant."
+def build_sql_prompt(config) -> str:
+    """System prompt for the Text-to-SQL specialist."""
+    shared_config = load_config()
 
-    # 2. Load Examples
-    try:
-        examples_path = os.path.join(os.path.dirname(__file__), "config", "examples.json")
-        with open(examples_path, "r") as f:
-            examples_data = json.load(f)
-            examples_text = "\n\n### SQL Few-Shot Examples:\n"
-            for ex in examples_data:
-                examples_text += f"User: {ex['question']}\nSQL: {ex['sql']}\n\n"
-    except FileNotFoundError:
-        examples_text = ""
+    return f"""
+    You are a SQL Expert for the Resilitix BigQuery data.
+    
+    {shared_config}
     
-    return base_instructions + "\n" + examples_text
+    1. Convert the user's request into a single Standard SQL query.
+    2. Use the `run_sql` tool to execute it.
+    3. If the query fails, analyze the error and try again.
+    4. Return the exact JSON output from the `run_sql` tool call.
+    5. If the request includes a "Resolved geography" block, filter with its exact County/State values
+       instead of LIKE patterns, and when hex ids are listed use `hex_id IN (...)` instead of joining the crosswalk.
+    """
+
+model_registry.register(
+    "sql_agent",
+    system_prompt=lambda: config_registry.prompt("sql_agent", build_sql_prompt),
+    functions=[FunctionDeclaration(
+        name="run_sql",
+        description="Executes a Standard SQL query on the BigQuery dataset.",
+        parameters={"type": "object", "properties": {"query": {"type": "string"}}, "required": ["query"]}
+    )],
+)
 
-def execute_bigquery_request(query: str) -> Dict[str, Any]:
-    """Raw helper to hit the Cloud Run SQL Tool and get data."""
-    print(f"    [Execution] Sending SQL to Cloud Run: {query[:80]}...")
-    payload = json.dumps({"query": query})
+def execute_generated_sql(sql_q: str) -> Dict[str, Any]:
+    """Runs model-written SQL: local schema validation, then BigQuery dry run, then execution."""
+    return validation_error(sql_q) or execute_checked_bigquery_request(sql_q)
+
+async def execute_generated_sql_async(sql_q: str) -> Dict[str, Any]:
+    """Async variant of execute_generated_sql (validation is local, so it runs inline)."""
+    return validation_error(sql_q) or await execute_checked_bigquery_request_async(sql_q)
+
+def _semantic_cache_output(user_query: str, entry, score: float, data_result: Dict[str, Any]):
+    """Agent output for a reused SQL (None if it no longer runs, which also drops the entry)."""
+    if "error" in data_result:
+        get_semantic_cache().invalidate(entry.sql)
+        return None
+    return {
+        "request": user_query,
+        "generated_sql": entry.sql,
+        "execution_result": data_result,
+        "semantic_cache": {"matched_question": entry.question, "similarity": round(score, 3)},
+    }
+
+def reuse_cached_sql(user_query: str):
+    """
+    Semantic cache lookup before the LLM conversation.
+    Returns (question embedding or None, agent output if a cached SQL was reused and still runs).
+    """
+    cache = get_semantic_cache()
+    if cache is None:
+        return None, None
     try:
-        token = get_id_token(TOOL_URL)
-        headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {token}'}
-        response = requests.post(TOOL_URL, data=payload, headers=headers)
-        
-        if response.status_code != 200:
-            return {"error": f"HTTP {response.status_code} Error. Raw response: {response.text}"}
-        
-        try:
-            return response.json()
-        except json.JSONDecodeError:
-            return {"error": f"Invalid JSON received. Raw content: {response.text}"}
+        vector = cache.embed(user_query)
+        hit = cache.lookup_vector(user_query, vector)
     except Exception as e:
-        return {"error": f"Connection Exception: {str(e)}"}
-        
-def execute_rag_search(query: str) -> Dict[str, Any]:
-    """Raw helper to hit Vertex AI Search."""
+        print(f"    [Agent A: SQL] Semantic cache unavailable: {e}")
+        return None, None
+    if hit is None:
+        return vector, None
+
+    entry, score = hit
+    print(f"    [Agent A: SQL] Semantic cache hit ({score:.3f}): '{entry.question}'")
+    return vector, _semantic_cache_output(user_query, entry, score, execute_generated_sql(entry.sql))
+
+async def reuse_cached_sql_async(user_query: str):
+    """Async variant of reuse_cached_sql."""
+    cache = get_semantic_cache()
+    if cache is None:
+        return None, None
     try:
-        client_options = {"api_endpoint": "discoveryengine.googleapis.com"}
-        client = discoveryengine.SearchServiceClient(client_options=client_options)
-        serving_config = client.serving_config_path(
-            project=PROJECT_ID, location="global", data_store=RAG_DATA_STORE_ID, serving_config="default_search",
-        )
-        request = discoveryengine.SearchRequest(
-            serving_config=serving_config, query=query, page_size=5,
-            content_search_spec=discoveryengine.SearchRequest.ContentSearchSpec(
-                summary_spec=discoveryengine.SearchRequest.ContentSearchSpec.SummarySpec(summary_result_count=5)
-            )
-        )
-        response = client.search(request)
-        
-        summary = ""
-        if response.summary and response.summary.summary_with_metadata:
-             summary = response.summary.summary_with_metadata.summary
-             
-        return {"summary": summary, "found": bool(summary)}
+        vector = await cache.embed_async(user_query)
+        hit = cache.lookup_vector(user_query, vector)
     except Exception as e:
-        return {"error": str(e)}
+        print(f"    [Agent A: SQL] Semantic cache unavailable: {e}")
+        return None, None
+    if hit is None:
+        return vector, None
+
+    entry, score = hit
+    print(f"    [Agent A: SQL] Semantic cache hit ({score:.3f}): '{entry.question}'")
+    return vector, _semantic_cache_output(user_query, entry, score, await execute_generated_sql_async(entry.sql))
+
+def remember_sql(user_query: str, vector, final_output: Dict[str, Any]):
+    """Adds the question and its SQL to the semantic cache once the SQL has executed successfully."""
+    result = final_output.get("execution_result")
+    if vector is not None and isinstance(result, dict) and "error" not in result:
+        get_semantic_cache().add_vector(user_query, final_output["generated_sql"], vector)
+
+def start_sql_chat() -> ChatSession:
+    """Fresh chat session on the shared Text-to-SQL specialist model."""
+    return model_registry.start_chat("sql_agent")
+
+def sql_request(user_query: str) -> str:
+    """First user turn for the SQL agent: the question plus any geography resolved by the local crosswalk index."""
+    hint = geography_hint(user_query)
+    return f"{hint}\n\nUser Request: {user_query}" if hint else user_query
+
+def sql_output(user_query: str, loop) -> Dict[str, Any]:
+    """
+    SQL agent answer: the last query the model issued. Calls of one turn run concurrently,
+    so this is taken from the loop's call order after it finishes, not from whichever
+    handler returned last.
+    """
+    call = loop.last_call("run_sql")
+    if call is None:
+        return {"error": "SQL Agent could not process request."}
+    return {"request": user_query, "generated_sql": call.args["query"], "execution_result": call.result}
+
+def map_output(user_query: str, loop) -> Dict[str, Any]:
+    """Mapping agent answer: the last map query the model issued (see sql_output)."""
+    call = loop.last_call("run_map_sql")
+    if call is None:
+        return {"error": "Mapping Agent could not process request."}
+    return {
+        "request": user_query,
+        "context_used": "SQL context summary...",
+        "generated_map_sql": call.args["query"],
+        "map_data_result": call.result,
+    }
 
 def agent_text_to_sql(user_query: str) -> Dict[str, Any]:
     """
     SPECIALIST A: Data Analyst Agent (Text-to-SQL).
     """
     print(f"\n  [Agent A: SQL] Processing Request: '{user_query}'")
-    
-    sql_func = FunctionDeclaration(
-        name="run_sql",
-        description="Executes a Standard SQL query on the BigQuery dataset.",
-        parameters={"type": "object", "properties": {"query": {"type": "string"}}, "required": ["query"]}
-    )
-    sql_tool = Tool(function_declarations=[sql_func])
-
-    # Load shared config (Schema/Examples)
-    shared_config = load_config()
 
-    system_prompt = f"""
-    You are a SQL Expert for the Resilitix BigQuery data.
-    
-    {shared_config}
+    # Near-duplicate of an earlier question: reuse its SQL and skip generation
+    vector, cached_output = reuse_cached_sql(user_query)
+    if cached_output is not None:
+        print(f"    [Agent A: SQL] Final Output: {cached_output}")
+        return cached_output
     
-    1. Convert the user's request into a single Standard SQL query.
-    2. Use the `run_sql` tool to execute it.
-    3. If the query fails, analyze the error and try again.
-    4. Return the exact JSON output from the `run_sql` tool call.
-    """
+    def run_sql(args):
+        sql_q = args["query"]
+        print(f"    [Agent A: SQL] Generated SQL: {sql_q}")
+        return execute_generated_sql(sql_q)
 
-    model = GenerativeModel("gemini-2.5-flash", system_instruction=system_prompt, tools=[sql_tool])
-    chat = model.start_chat()
-    
-    response = chat.send_message(user_query)
-    
-    final_output = {"error": "SQL Agent could not process request."}
-    
-    # --- RETRY LOOP FOR SQL AGENT ---
-    # We loop up to 5 times to allow the model to fix bad SQL or refine results
-    for _ in range(10):
-        try:
-            # Check if we have a response content
-            if not response.candidates:
-                break
-
-            part = response.candidates[0].content.parts[0]
-
-            # If it's just text (no tool call), we assume the agent is done or asking for clarification
-            if not part.function_call:
-                break
-
-            # Handle Tool Call
-            fn = part.function_call
-            if fn.name == "run_sql":
-                sql_q = fn.args["query"]
-                print(f"    [Agent A: SQL] Generated SQL: {sql_q}")
-                
-                # Execute SQL
-                data_result = execute_bigquery_request(sql_q)
-                
-                # Prepare Result
-                full_result = {
-                    "request": user_query,
-                    "generated_sql": sql_q,
-                    "execution_result": data_result
-                }
-
-                # Send result back to Model (This allows the loop to continue or finish)
-                response = chat.send_message(
-                    Part.from_function_response(name="run_sql", response={"content": data_result})
-                )
-
-        except Exception as e:
-            traceback.print_exc()
-            final_output = {"error": f"SQL Agent Internal Error: {e}"}
-            break
+    # --- TOOL LOOP FOR SQL AGENT ---
+    # Bounded so the model can fix bad SQL or refine results without spiralling
+    try:
+        loop = run_tool_loop(start_sql_chat(), sql_request(user_query), {"run_sql": run_sql},
+                             name="Agent A: SQL", max_turns=10)
+        final_output = sql_output(user_query, loop)
+    except Exception as e:
+        traceback.print_exc()
+        final_output = {"error": f"SQL Agent Internal Error: {e}"}
+
+    remember_sql(user_query, vector, final_output)
 
     print(f"    [Agent A: SQL] Final Output: {final_output}")
 
     return final_output
 
-def agent_rag(user_query: str) -> Dict[str, Any]:
-    """
-    SPECIALIST B: RAG Agent (Document Search).
+RAG_SYSTEM_PROMPT = """
+    You are a Knowledge Librarian. 
+    1. Search the knowledge base for the user's query using `search_knowledge_base`.
+    2. Answer strictly based on the search results. Return the final, concise answer only.
     """
-    print(f"\n  [Agent B: RAG] Processing Request: '{user_query}'")
-    
-    search_func = FunctionDeclaration(
+
+model_registry.register(
+    "rag_agent",
+    system_prompt=lambda: RAG_SYSTEM_PROMPT,
+    functions=[FunctionDeclaration(
         name="search_knowledge_base",
         description="Search the document knowledge base for contextual information and facts.",
         parameters={"type": "object", "properties": {"query": {"type": "string"}}, "required": ["query"]}
-    )
-    rag_tool = Tool(function_declarations=[search_func])
+    )],
+)
 
-    system_prompt = """
-    You are a Knowledge Librarian. 
-    1. Search the knowledge base for the user's query using `search_knowledge_base`.
-    2. Answer strictly based on the search results. Return the final, concise answer only.
+def start_rag_chat() -> ChatSession:
+    """Fresh chat session on the shared RAG specialist model."""
+    return model_registry.start_chat("rag_agent")
+
+def agent_rag(user_query: str) -> Dict[str, Any]:
     """
+    SPECIALIST B: RAG Agent (Document Search).
+    """
+    print(f"\n  [Agent B: RAG] Processing Request: '{user_query}'")
     
-    model = GenerativeModel("gemini-2.5-flash", system_instruction=system_prompt, tools=[rag_tool])
-    chat = model.start_chat()
-    
-    response = chat.send_message(user_query)
+    def search_knowledge_base(args):
+        q = args["query"]
+        print(f"    [Agent B: RAG] Search Query: {q}")
+        return execute_rag_search(q)
+
     final_answer = {"text": "RAG Agent found no information."}
 
     try:
-        # Simple single-turn loop for RAG usually suffices
-        while response.candidates[0].content.parts[0].function_call:
-            fn = response.candidates[0].content.parts[0].function_call
-            if fn.name == "search_knowledge_base":
-                q = fn.args["query"]
-                print(f"    [Agent B: RAG] Search Query: {q}")
-                
-                search_result = execute_rag_search(q)
-                
-                response = chat.send_message(
-                    Part.from_function_response(name="search_knowledge_base", response={"content": search_result})
-                )
-                final_answer = {"text": response.text, "search_summary": search_result["summary"]}
+        # A single search usually suffices
+        loop = run_tool_loop(start_rag_chat(), user_query, {"search_knowledge_base": search_knowledge_base},
+                             name="Agent B: RAG", max_turns=3)
+        search = loop.last_call("search_knowledge_base")
+        if search is not None:
+            final_answer = {"text": loop.text, "search_summary": search.result.get("summary")}
                 
     except Exception as e:
         final_answer = {"error": f"RAG Agent Internal Error: {e}"}
@@ -226,75 +241,147 @@ def agent_rag(user_query: str) -> Dict[str, Any]:
         
     return final_answer
 
-def agent_mapping(user_query: str, previous_query: str) -> Dict[str, Any]:
-    """
-    SPECIALIST C: Mapping Agent.
-    """
-    print(f"\n  [Agent C: Mapping] Processing Request: '{user_query}'")
-    
+def build_mapping_prompt(config) -> str:
+    """System prompt for the Mapping specialist (the reference query is sent with the user turn)."""
     # Load shared config so map agent knows table schemas too
     shared_config = load_config()
 
-    sql_func = FunctionDeclaration(
-        name="run_map_sql",
-        description="Executes SQL. Must return the 'hex_id' (H3 index) and a 'value' column.",
-        parameters={"type": "object", "properties": {"query": {"type": "string"}}, "required": ["query"]}
-    )
-    map_tool = Tool(function_declarations=[sql_func])
-
-    system_prompt = f"""
+    return f"""
     You are a Geospatial Visualization Expert.
     
     {shared_config}
     
-    Reference SQL Query: {previous_query}
-    
-    1. Analyze the user query and the context to generate a NEW SQL query.
+    1. Analyze the user query and the Reference SQL Query given with it to generate a NEW SQL query.
     2. The query MUST include a column named 'hex_id' from the hex_county_state_zip_crosswalk table with column name 'hex_id_l6'(H3 Index at level 6) and a numeric column named 'value'.
     3. Execute the query using `run_map_sql`.
     4. Return the exact JSON output. Do NOT summarize or chat.
     """
 
-    model = GenerativeModel("gemini-2.5-flash", system_instruction=system_prompt, tools=[map_tool])
-    chat = model.start_chat()
+model_registry.register(
+    "mapping_agent",
+    system_prompt=lambda: config_registry.prompt("mapping_agent", build_mapping_prompt),
+    functions=[FunctionDeclaration(
+        name="run_map_sql",
+        description="Executes SQL. Must return the 'hex_id' (H3 index) and a 'value' column.",
+        parameters={"type": "object", "properties": {"query": {"type": "string"}}, "required": ["query"]}
+    )],
+)
+
+def start_mapping_chat() -> ChatSession:
+    """Fresh chat session on the shared Mapping specialist model."""
+    return model_registry.start_chat("mapping_agent")
+
+def mapping_request(user_query: str, previous_query: str) -> str:
+    """First user turn for the Mapping specialist."""
+    hint = geography_hint(user_query)
+    hint = f"{hint}\n\n" if hint else ""
+    return f"Reference SQL Query: {previous_query}\n\n{hint}User Request: {user_query}"
+
+def agent_mapping(user_query: str, previous_query: str) -> Dict[str, Any]:
+    """
+    SPECIALIST C: Mapping Agent.
+    """
+    print(f"\n  [Agent C: Mapping] Processing Request: '{user_query}'")
     
-    response = chat.send_message(user_query)
-    final_output = {"error": "Mapping Agent could not process request."}
-
-    # Retry loop for Mapping Agent as well (in case SQL fails)
-    for _ in range(5):
-        try:
-            if not response.candidates: break
-            part = response.candidates[0].content.parts[0]
-            if not part.function_call: break
-
-            fn = part.function_call
-            if fn.name == "run_map_sql":
-                sql_q = fn.args["query"]
-                print(f"    [Agent C: Mapping] Generated SQL: {sql_q}")
-                
-                data_result = execute_bigquery_request(sql_q)
-                
-                full_result = {
-                    "request": user_query,
-                    "context_used": "SQL context summary...",
-                    "generated_map_sql": sql_q,
-                    "map_data_result": data_result
-                }
-
-                response = chat.send_message(
-                    Part.from_function_response(name="run_map_sql", response={"content": data_result})
-                )
-                final_output = full_result
-                
-        except Exception as e:
-            final_output = {"error": f"Mapping Agent Internal Error: {e}"}
-            break
+    def run_map_sql(args):
+        sql_q = args["query"]
+        print(f"    [Agent C: Mapping] Generated SQL: {sql_q}")
+        return execute_generated_sql(sql_q)
+
+    # Bounded loop for the Mapping Agent as well (in case SQL fails)
+    try:
+        loop = run_tool_loop(start_mapping_chat(), mapping_request(user_query, previous_query),
+                             {"run_map_sql": run_map_sql}, name="Agent C: Mapping", max_turns=5)
+        final_output = map_output(user_query, loop)
+    except Exception as e:
+        final_output = {"error": f"Mapping Agent Internal Error: {e}"}
     
     print(f"    [Agent C: Mapping] Final Output: {final_output}")
 
     return final_output
 
+# Async specialists (same prompts and loops, non-blocking Gemini / tool calls)
+
+async def agent_text_to_sql_async(user_query: str) -> Dict[str, Any]:
+    """
+    SPECIALIST A (async): Data Analyst Agent (Text-to-SQL).
+    """
+    print(f"\n  [Agent A: SQL] Processing Request: '{user_query}'")
+
+    vector, cached_output = await reuse_cached_sql_async(user_query)
+    if cached_output is not None:
+        print(f"    [Agent A: SQL] Final Output: {cached_output}")
+        return cached_output
+
+    async def run_sql(args):
+        sql_q = args["query"]
+        print(f"    [Agent A: SQL] Generated SQL: {sql_q}")
+        return await execute_generated_sql_async(sql_q)
+
+    try:
+        loop = await run_tool_loop_async(start_sql_chat(), sql_request(user_query), {"run_sql": run_sql},
+                                         name="Agent A: SQL", max_turns=10)
+        final_output = sql_output(user_query, loop)
+    except Exception as e:
+        traceback.print_exc()
+        final_output = {"error": f"SQL Agent Internal Error: {e}"}
+
+    remember_sql(user_query, vector, final_output)
+
+    print(f"    [Agent A: SQL] Final Output: {final_output}")
+
+    return final_output
+
+async def agent_rag_async(user_query: str) -> Dict[str, Any]:
+    """
+    SPECIALIST B (async): RAG Agent (Document Search).
+    """
+    print(f"\n  [Agent B: RAG] Processing Request: '{user_query}'")
+
+    async def search_knowledge_base(args):
+        q = args["query"]
+        print(f"    [Agent B: RAG] Search Query: {q}")
+        return await execute_rag_search_async(q)
+
+    final_answer = {"text": "RAG Agent found no information."}
+
+    try:
+        loop = await run_tool_loop_async(start_rag_chat(), user_query,
+                                         {"search_knowledge_base": search_knowledge_base},
+                                         name="Agent B: RAG", max_turns=3)
+        search = loop.last_call("search_knowledge_base")
+        if search is not None:
+            final_answer = {"text": loop.text, "search_summary": search.result.get("summary")}
+
+    except Exception as e:
+        final_answer = {"error": f"RAG Agent Internal Error: {e}"}
+
+    print(f"    [Agent B: RAG] Final Answer: {final_answer}")
+
+    return final_answer
+
+async def agent_mapping_async(user_query: str, previous_query: str) -> Dict[str, Any]:
+    """
+    SPECIALIST C (async): Mapping Agent.
+    """
+    print(f"\n  [Agent C: Mapping] Processing Request: '{user_query}'")
+
+    async def run_map_sql(args):
+        sql_q = args["query"]
+        print(f"    [Agent C: Mapping] Generated SQL: {sql_q}")
+        return await execute_generated_sql_async(sql_q)
+
+    try:
+        loop = await run_tool_loop_async(start_mapping_chat(), mapping_request(user_query, previous_query),
+                                         {"run_map_sql": run_map_sql}, name="Agent C: Mapping", max_turns=5)
+        final_output = map_output(user_query, loop)
+    except Exception as e:
+        final_output = {"error": f"Mapping Agent Internal Error: {e}"}
+
+    print(f"    [Agent C: Mapping] Final Output: {final_output}")
+
+    return final_output
+
 class Result(BaseModel):
     name: str
     query: str
@@ -303,7 +390,8 @@ class Result(BaseModel):
 class AgentState(TypedDict):
     messages: Annotated[Sequence[BaseMessage], add_messages]
     task: Literal[str]
-    results: Optional[list[Result]]
+    # sql_agent and rag_agent run in parallel, so their results are concatenated rather than overwritten
+    results: Annotated[list[Result], operator.add]
 
 def sql_agent(state: AgentState):
     """SQL agent for the task"""
@@ -313,6 +401,10 @@ def sql_agent(state: AgentState):
     
     output = agent_text_to_sql(user_query)
 
+    return sql_state_update(output)
+
+def sql_state_update(output: Dict[str, Any]):
+    """Turns the SQL specialist output into a graph state update"""
     if "error" in output:
         return {"messages": [AIMessage(content=f"Error: {output['error']}")]}
 
@@ -331,7 +423,13 @@ def rag_agent(state: AgentState):
     print("="*10, " Inside RAG Agent ", "="*10)
 
     user_query = state["task"] or state["messages"][-1].content
-    rag_output = agent_rag(user_query)["text"]
+    rag_answer = agent_rag(user_query)
+
+    return rag_state_update(user_query, rag_answer)
+
+def rag_state_update(user_query: str, rag_answer: Dict[str, Any]):
+    """Turns the RAG specialist output into a graph state update"""
+    rag_output = rag_answer.get("text") or f"Error: {rag_answer.get('error')}"
 
     rag_result = Result(name = "rag_agent", query=user_query, output=rag_output)
 
@@ -340,6 +438,11 @@ def rag_agent(state: AgentState):
         "results": [rag_result],
     }
 
+def join_results(state: AgentState):
+    """Join point for the parallel SQL and RAG branches (both results are merged by the reducer)"""
+    print("="*10, " Joined SQL and RAG Agents ", "="*10)
+    return {}
+
 def is_plot_required(state: AgentState) -> bool:
     """
     Decide whether the user query should trigger the Mapping / Plot Agent.
@@ -383,10 +486,19 @@ def plot_agent(state: AgentState):
     print("="*10, " Inside Plot Agent ", "="*10)
 
     user_query = state["task"] or state["messages"][-1].content
-    previous_query = state["results"][0].query
+    previous_query = next((r.query for r in state["results"] if r.name == "sql_agent"), "")
 
     mapping_output = agent_mapping(user_query, previous_query)
 
+    return plot_state_update(mapping_output)
+
+def plot_state_update(mapping_output: Dict[str, Any]):
+    """Turns the Mapping specialist output into a graph state update"""
+    # A failed map must not abort the run: the SQL and RAG results still reach the summary
+    if "error" in mapping_output or "generated_map_sql" not in mapping_output:
+        error = mapping_output.get("error", "Mapping Agent returned no map query.")
+        return {"messages": [AIMessage(content=f"Plot Error: {error}")]}
+
     plot_query = mapping_output["generated_map_sql"]
     plot_output = mapping_output["map_data_result"]
 
@@ -396,10 +508,21 @@ def plot_agent(state: AgentState):
         "results": [plot_result],
     }
 
-def summarize_agent(state: AgentState):
-    """Summarize agent for the task using a chat model"""
-    print("=" * 10, " Inside Summarize Agent ", "=" * 10)
+SUMMARY_SYSTEM_PROMPT = """
+    You are a information summarizer preparing a concise research report.
+
+    STRICT RULES:
+    - Summarize ONLY the information provided.
+    - Do NOT invent metrics, trends, or conclusions.
+    - If information is missing or inconclusive, say so explicitly.
+    - Clearly separate data-driven findings from contextual references.
+    - Be concise, factual, and professional.
+    """
+
+model_registry.register("summarize_agent", system_prompt=lambda: SUMMARY_SYSTEM_PROMPT)
 
+def build_summary_request(state: AgentState):
+    """Builds a summarizer chat and the user prompt from the merged specialist results"""
     user_query = state.get("task") or state["messages"][-1].content
     results = state.get("results", [])
 
@@ -420,17 +543,6 @@ def summarize_agent(state: AgentState):
                 "output": r.output
             }, indent=2)
 
-    system_prompt = """
-    You are a information summarizer preparing a concise research report.
-
-    STRICT RULES:
-    - Summarize ONLY the information provided.
-    - Do NOT invent metrics, trends, or conclusions.
-    - If information is missing or inconclusive, say so explicitly.
-    - Clearly separate data-driven findings from contextual references.
-    - Be concise, factual, and professional.
-    """
-
     user_prompt = f"""
     User Question:
     {user_query}
@@ -446,12 +558,17 @@ def summarize_agent(state: AgentState):
     using ONLY the information above.
     """
 
-    model = GenerativeModel(
-        "gemini-2.5-flash",
-        system_instruction=system_prompt
-    )
+    # A one-turn chat rather than generate_content, so the turn can be served by the response cache
+    return model_registry.start_chat("summarize_agent"), user_prompt
+
+def summarize_agent(state: AgentState, writer: StreamWriter):
+    """Summarize agent for the task using a chat model (tokens streamed as custom events)"""
+    print("=" * 10, " Inside Summarize Agent ", "=" * 10)
 
-    response = model.generate_content(user_prompt)
+    chat, user_prompt = build_summary_request(state)
+
+    # Each text delta reaches stream_mode="custom" consumers as soon as Gemini produces it
+    response = stream_turn(chat, user_prompt, lambda text: writer({"summary_token": text}))
 
     ai_message = AIMessage(content=response.text)
 
@@ -459,31 +576,85 @@ def summarize_agent(state: AgentState):
         "messages": [ai_message],
     }
 
-graph = StateGraph(AgentState)
+# Async graph nodes
 
-graph.add_node("sql_agent", sql_agent)
-graph.add_node("rag_agent", rag_agent)
-graph.add_node("plot_agent", plot_agent)
-graph.add_node("summarize_agent", summarize_agent)
+async def sql_agent_async(state: AgentState):
+    """SQL agent for the task (async)"""
+    print("="*10, " Inside SQL Agent ", "="*10)
 
-graph.set_entry_point("sql_agent")
+    user_query = state["task"] or state["messages"][-1].content
+    output = await agent_text_to_sql_async(user_query)
 
-graph.add_edge("sql_agent", "rag_agent")
+    return sql_state_update(output)
 
-graph.add_conditional_edges(
-    "rag_agent",
-    is_plot_required,
-    {
-        "plot_agent": "plot_agent",
-        "summarize_agent": "summarize_agent",
-    },
-)
+async def rag_agent_async(state: AgentState):
+    """RAG agent for the task (async)"""
+    print("="*10, " Inside RAG Agent ", "="*10)
+
+    user_query = state["task"] or state["messages"][-1].content
+    rag_answer = await agent_rag_async(user_query)
+
+    return rag_state_update(user_query, rag_answer)
+
+async def plot_agent_async(state: AgentState):
+    """Plot agent for the task (async)"""
+    print("="*10, " Inside Plot Agent ", "="*10)
+
+    user_query = state["task"] or state["messages"][-1].content
+    previous_query = next((r.query for r in state["results"] if r.name == "sql_agent"), "")
 
-graph.add_edge("plot_agent", "summarize_agent")
+    mapping_output = await agent_mapping_async(user_query, previous_query)
 
-graph.add_edge("summarize_agent", END)
+    return plot_state_update(mapping_output)
 
-app = graph.compile()
+async def summarize_agent_async(state: AgentState, writer: StreamWriter):
+    """Summarize agent for the task (async, tokens streamed as custom events)"""
+    print("=" * 10, " Inside Summarize Agent ", "=" * 10)
+
+    chat, user_prompt = build_summary_request(state)
+    response = await stream_turn_async(chat, user_prompt, lambda text: writer({"summary_token": text}))
+
+    return {
+        "messages": [AIMessage(content=response.text)],
+    }
+
+def build_graph(sql_node, rag_node, plot_node, summarize_node) -> CompiledStateGraph:
+    """Wires the specialist nodes into the multi-agent graph and compiles it"""
+    graph = StateGraph(AgentState)
+
+    # Specialist nodes report start / end (and their tool calls) as "custom" stream events,
+    # and each run is a tracing span
+    graph.add_node("sql_agent", instrument_node("sql_agent", traced("sql_agent")(sql_node)))
+    graph.add_node("rag_agent", instrument_node("rag_agent", traced("rag_agent")(rag_node)))
+    graph.add_node("join_results", join_results)
+    graph.add_node("plot_agent", instrument_node("plot_agent", traced("plot_agent")(plot_node)))
+    graph.add_node("summarize_agent", instrument_node("summarize_agent", traced("summarize_agent")(summarize_node)))
+
+    # Fan out: the SQL and RAG specialists are independent, so run them in the same superstep
+    graph.add_edge(START, "sql_agent")
+    graph.add_edge(START, "rag_agent")
+
+    # Fan in: wait for both branches before routing
+    graph.add_edge(["sql_agent", "rag_agent"], "join_results")
+
+    graph.add_conditional_edges(
+        "join_results",
+        is_plot_required,
+        {
+            "plot_agent": "plot_agent",
+            "summarize_agent": "summarize_agent",
+        },
+    )
+
+    graph.add_edge("plot_agent", "summarize_agent")
+
+    graph.add_edge("summarize_agent", END)
+
+    return graph.compile()
+
+# Blocking app (invoke/stream) and async app (ainvoke/astream) over the same topology
+app = build_graph(sql_agent, rag_agent, plot_agent, summarize_agent)
+async_app = build_graph(sql_agent_async, rag_agent_async, plot_agent_async, summarize_agent_async)
 
 
 import json
@@ -503,11 +674,47 @@ def main(test_query):
     print(f"User Query: {test_query}\n")
 
     # 3. Stream the graph execution
-    # This allows you to see the output of each node as it completes
-    
-    result = app.invoke(initial_input)
+    # Progress events and summary tokens arrive as "custom" chunks while the nodes run; "values" carries the state
+    result = None
+    for mode, chunk in app.stream(initial_input, stream_mode=["custom", "values"]):
+        if mode == "custom" and "event" in chunk:
+            print(f"  [Progress] {format_event(chunk['event'])}")
+        elif mode == "custom" and "summary_token" in chunk:
+            print(chunk["summary_token"], end="", flush=True)
+        elif mode == "values":
+            result = chunk
+    print()
     print("="*50)
     print("Final Result: ", result)
+
+async def stream_answer(test_query: str):
+    """Yields the final summary text token by token as the async graph produces it."""
+    initial_input = {"task": test_query, "messages": [HumanMessage(content=test_query)], "results": []}
+    async for chunk in async_app.astream(initial_input, stream_mode="custom"):
+        if "summary_token" in chunk:
+            yield chunk["summary_token"]
+
+async def stream_progress(test_query: str):
+    """Yields the async graph's progress events (node start/end, tool calls, rows, timings) as they happen."""
+    initial_input = {"task": test_query, "messages": [HumanMessage(content=test_query)], "results": []}
+    async for chunk in async_app.astream(initial_input, stream_mode="custom"):
+        if "event" in chunk:
+            yield chunk["event"]
+
+async def main_async(test_queries):
+    """Runs several user sessions concurrently on the async app."""
+    initial_inputs = [
+        {"task": q, "messages": [HumanMessage(content=q)], "results": []}
+        for q in test_queries
+    ]
+
+    print(f"\n{'='*20} STARTING {len(initial_inputs)} CONCURRENT RUNS {'='*20}")
+
+    results = await asyncio.gather(*(async_app.ainvoke(i) for i in initial_inputs))
+    for q, result in zip(test_queries, results):
+        print("="*50)
+        print(f"User Query: {q}")
+        print("Final Result: ", result)
     
 if __name__ == "__main__":
     # Ensure you have your environment variables set (PROJECT_ID, TOOL_URL, etc.)
@@ -0,0 +1,191 @@
+"""
+Opt-in, on-disk cache of Gemini chat responses.
+
+A response is keyed on the model, a hash of the system prompt and tool schema,
+the generation config, the chat history so far (including tool results) and the
+new message. Identical turns (repeated demo questions, test_agents.py reruns)
+are answered from a local SQLite file with LRU eviction instead of the network.
+
+LLM_CACHE=off (default) disables it, "on" reads and writes, and "replay" only
+reads: a miss raises LLMCacheMiss, so recorded sessions can be replayed offline.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from vertexai.generative_models import ChatSession, Content, GenerationResponse, Part
+
+# --- CONFIGURATION ---
+LLM_CACHE_MODE = os.environ.get("LLM_CACHE", "off")  # off | on | replay
+LLM_CACHE_PATH = os.environ.get("LLM_CACHE_PATH", os.path.join(os.path.dirname(__file__), ".llm_cache.sqlite"))
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "5000"))
+LLM_CACHE_TTL_S = float(os.environ.get("LLM_CACHE_TTL_S", str(7 * 24 * 3600)))
+
+class LLMCacheMiss(LookupError):
+    """Raised in replay mode when a turn was never recorded."""
+
+class ResponseStore:
+    """SQLite-backed LRU store of serialized responses."""
+
+    def __init__(self, path: str = LLM_CACHE_PATH, max_entries: int = LLM_CACHE_MAX_ENTRIES,
+                 ttl: float = LLM_CACHE_TTL_S):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "key TEXT PRIMARY KEY, response TEXT, created_at REAL, last_access REAL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT response, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] + self.ttl < time.time():
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+            return json.loads(row[0])
+
+    def set(self, key: str, response: Dict[str, Any]):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, response, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(response), now, now),
+            )
+            # Evict least recently used entries beyond the limit
+            self._conn.execute(
+                "DELETE FROM llm_cache WHERE key IN ("
+                "SELECT key FROM llm_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+def _user_content(message) -> Content:
+    """The user turn ChatSession would append for `message` (str, Part or a list of them)."""
+    items = message if isinstance(message, list) else [message]
+    return Content(role="user", parts=[Part.from_text(m) if isinstance(m, str) else m for m in items])
+
+def _schema_hash(system_prompt: Optional[str], tools) -> str:
+    tool_dicts = []
+    for tool in tools or []:
+        try:
+            tool_dicts.append(tool.to_dict())
+        except Exception:
+            tool_dicts.append(repr(tool))
+    payload = json.dumps({"system": system_prompt or "", "tools": tool_dicts}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class CachedChat:
+    """
+    ChatSession wrapper that answers repeated turns from the ResponseStore.
+    On a hit the user turn and the cached reply are appended to the wrapped session's
+    history, so later turns (and their cache keys) continue exactly as after a live call.
+    """
+
+    def __init__(self, chat: ChatSession, store: ResponseStore, model_name: str, schema_hash: str,
+                 generation_config: Optional[Dict[str, Any]] = None, replay: bool = False):
+        self._chat = chat
+        self._store = store
+        self._prefix = {"model": model_name, "schema": schema_hash, "generation_config": generation_config or {}}
+        self._replay = replay
+
+    def __getattr__(self, name):
+        return getattr(self._chat, name)
+
+    @property
+    def history(self) -> List[Content]:
+        return self._chat.history
+
+    def _key(self, content: Content) -> str:
+        payload = {
+            **self._prefix,
+            "history": [c.to_dict() for c in self._chat.history],
+            "message": content.to_dict(),
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def _lookup(self, content: Content):
+        key = self._key(content)
+        cached = self._store.get(key)
+        if cached is None:
+            if self._replay:
+                raise LLMCacheMiss(f"No recorded response for turn {key[:12]}")
+            return key, None
+        response = GenerationResponse.from_dict(cached)
+        self._chat._history.extend([content, response.candidates[0].content])
+        print(f"    [LLM Cache] HIT {key[:12]}")
+        return key, response
+
+    def _record(self, key: str, response: GenerationResponse):
+        # Only complete, single-candidate turns are worth replaying
+        if response.candidates:
+            self._store.set(key, response.to_dict())
+
+    def _record_stream(self, key: str, chunks):
+        """Passes streamed chunks through, then records the aggregated turn from the history."""
+        for chunk in chunks:
+            yield chunk
+        self._store.set(key, {"candidates": [{"content": self._chat.history[-1].to_dict()}]})
+
+    async def _record_stream_async(self, key: str, chunks):
+        async for chunk in chunks:
+            yield chunk
+        self._store.set(key, {"candidates": [{"content": self._chat.history[-1].to_dict()}]})
+
+    @staticmethod
+    async def _replay_async(response):
+        yield response
+
+    def send_message(self, message, stream: bool = False, **kwargs):
+        key, response = self._lookup(_user_content(message))
+        if stream:
+            # A hit is replayed as a single chunk
+            if response is not None:
+                return iter([response])
+            return self._record_stream(key, self._chat.send_message(message, stream=True, **kwargs))
+        if response is None:
+            response = self._chat.send_message(message, **kwargs)
+            self._record(key, response)
+        return response
+
+    async def send_message_async(self, message, stream: bool = False, **kwargs):
+        key, response = self._lookup(_user_content(message))
+        if stream:
+            if response is not None:
+                return self._replay_async(response)
+            return self._record_stream_async(key, await self._chat.send_message_async(message, stream=True, **kwargs))
+        if response is None:
+            response = await self._chat.send_message_async(message, **kwargs)
+            self._record(key, response)
+        return response
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store() -> ResponseStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ResponseStore()
+    return _store
+
+def cached_chat(chat: ChatSession, model_name: str, system_prompt: Optional[str] = None, tools=None,
+                generation_config: Optional[Dict[str, Any]] = None):
+    """Wraps `chat` in a CachedChat when LLM_CACHE is on (or replay); otherwise returns it unchanged."""
+    if LLM_CACHE_MODE not in ("on", "replay"):
+        return chat
+    return CachedChat(chat, get_store(), model_name, _schema_hash(system_prompt, tools),
+                      generation_config, replay=LLM_CACHE_MODE == "replay")
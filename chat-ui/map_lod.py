@@ -0,0 +1,117 @@
+"""
+Level-of-detail stage between a map SQL result and Kepler.
+
+When a result has more rows than the browser can render smoothly, hexes are
+rolled up to the finest coarser H3 resolution whose row count fits the budget.
+The target resolution is found on the distinct hex ids first, then the original
+rows are aggregated once (so means are over hexes, not means of means). The
+crosswalk parent columns (hex_id_l7 / hex_id_l6) are used when the query
+returned them; otherwise parents come from H3 math.
+
+Offline checks: python -m doctest map_lod.py
+"""
+
+import json
+import os
+from typing import Dict, Optional, Tuple
+
+import h3
+import pandas as pd
+
+# --- CONFIGURATION ---
+MAP_ROW_BUDGET = int(os.environ.get("MAP_ROW_BUDGET", "50000"))
+# Coarsest resolution the map will aggregate to
+MAP_MIN_RESOLUTION = int(os.environ.get("MAP_MIN_RESOLUTION", "3"))
+# Per-column aggregation overrides, e.g. {"value": "max", "population": "sum"}
+MAP_AGGREGATIONS = json.loads(os.environ.get("MAP_AGGREGATIONS", "{}"))
+
+SUPPORTED_AGGREGATIONS = {"sum", "mean", "max", "min"}
+
+# Crosswalk parent columns, by resolution
+CROSSWALK_PARENT_COLUMNS = {7: "hex_id_l7", 6: "hex_id_l6"}
+
+def hex_resolution(df: pd.DataFrame, hex_column: str = "hex_id") -> int:
+    """H3 resolution of the hexes in `hex_column` (taken from the first row)."""
+    return h3.get_resolution(str(df[hex_column].iloc[0]))
+
+def default_aggregations(df: pd.DataFrame, hex_column: str = "hex_id") -> Dict[str, str]:
+    """
+    Aggregation per column: integer columns (counts) are summed, float columns (scores,
+    rates) are averaged, everything else keeps its first value. MAP_AGGREGATIONS overrides.
+    """
+    aggregations = {}
+    for column in df.columns:
+        if column == hex_column or column in CROSSWALK_PARENT_COLUMNS.values():
+            continue
+        if pd.api.types.is_integer_dtype(df[column]):
+            aggregations[column] = "sum"
+        elif pd.api.types.is_numeric_dtype(df[column]):
+            aggregations[column] = "mean"
+        else:
+            aggregations[column] = "first"
+    aggregations.update({k: v for k, v in MAP_AGGREGATIONS.items() if k in aggregations})
+    return aggregations
+
+def rollup(df: pd.DataFrame, resolution: int, aggregations: Dict[str, str],
+           hex_column: str = "hex_id") -> pd.DataFrame:
+    """Aggregates rows to their parent hex at `resolution`, adding a `hex_count` column."""
+    parent_column = CROSSWALK_PARENT_COLUMNS.get(resolution)
+    if parent_column in df.columns:
+        parents = df[parent_column]
+    else:
+        parents = df[hex_column].map(lambda h: h3.cell_to_parent(h, resolution))
+
+    # Coarser crosswalk parents are constant within a group, so carry them along
+    carried = {c: "first" for r, c in CROSSWALK_PARENT_COLUMNS.items() if r < resolution and c in df.columns}
+    column_aggregations = {**aggregations, **carried}
+
+    grouped = df.assign(_parent=parents).groupby("_parent", sort=False)
+    sizes = grouped["hex_count"].sum() if "hex_count" in df.columns else grouped.size()
+    out = grouped.agg(column_aggregations) if column_aggregations else pd.DataFrame(index=sizes.index)
+    out["hex_count"] = sizes
+    out.index.name = hex_column
+    return out.reset_index()
+
+def target_resolution(df: pd.DataFrame, budget: int, hex_column: str = "hex_id") -> int:
+    """Finest resolution (not below MAP_MIN_RESOLUTION) at which `df` has at most `budget` distinct hexes."""
+    resolution = hex_resolution(df, hex_column)
+    cells = set(df[hex_column].astype(str))
+    while len(cells) > budget and resolution > MAP_MIN_RESOLUTION:
+        resolution -= 1
+        cells = {h3.cell_to_parent(c, resolution) for c in cells}
+    return resolution
+
+def apply_lod(df: pd.DataFrame, budget: int = MAP_ROW_BUDGET,
+              aggregations: Optional[Dict[str, str]] = None,
+              hex_column: str = "hex_id") -> Tuple[pd.DataFrame, Optional[int]]:
+    """
+    Rolls `df` up, in one aggregation, to the finest H3 level with at most `budget` rows.
+    Returns the (possibly unchanged) DataFrame and the resolution it was aggregated to,
+    or None if no aggregation was needed.
+
+    Means are over the original hexes, not means of per-level means (7 zeros under one
+    l7 parent and one 100 under another average to 12.5, not 50):
+
+    >>> l6 = h3.latlng_to_cell(29.76, -95.37, 6)
+    >>> first, second = h3.cell_to_children(l6, 7)[:2]
+    >>> cells = h3.cell_to_children(first, 8)[:7] + h3.cell_to_children(second, 8)[:1]
+    >>> df = pd.DataFrame({"hex_id": cells, "value": [0.0] * 7 + [100.0]})
+    >>> out, resolution = apply_lod(df, budget=1)
+        [Map LOD] Aggregated to H3 resolution 6: 1 rows
+    >>> resolution, out["value"].tolist(), out["hex_count"].tolist()
+    (6, [12.5], [8])
+    """
+    if len(df) <= budget or hex_column not in df.columns:
+        return df, None
+
+    aggregations = aggregations or default_aggregations(df, hex_column)
+    unsupported = {v for v in aggregations.values() if v not in SUPPORTED_AGGREGATIONS | {"first"}}
+    if unsupported:
+        raise ValueError(f"Unsupported map aggregation(s): {sorted(unsupported)}")
+
+    # Aggregate once from the original rows (at the base resolution this merges duplicate hexes)
+    resolution = target_resolution(df, budget, hex_column)
+    df = rollup(df, resolution, aggregations, hex_column)
+
+    print(f"    [Map LOD] Aggregated to H3 resolution {resolution}: {len(df)} rows")
+    return df, resolution
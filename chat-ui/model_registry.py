@@ -0,0 +1,230 @@
+"""
+Per-process registry of specialist models.
+
+Each specialist registers its tool schema and a system-prompt builder once.
+The GenerativeModel is constructed on first use and reused; callers get a
+fresh ChatSession per conversation. Model name and generation config come
+from config/models.json (overridable with environment variables), so they
+can be tuned without code edits.
+
+Specialists with a large static system prompt (schema + examples) can opt into
+Vertex AI context caching ("context_cache" in models.json): the prompt and tool
+schema are uploaded once as a CachedContent, shared by every session, and its
+TTL is extended while it is in use. Creating and refreshing the cache happen on a
+background thread, never on the request path: until the cache is ready (or while
+creation keeps failing, retried with backoff) sessions send the prompt inline.
+
+Specialists marked "response_cache" in models.json go through the opt-in on-disk
+response cache (llm_cache.py, enabled with LLM_CACHE=on).
+"""
+
+import datetime
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+from vertexai.generative_models import ChatSession, FunctionDeclaration, GenerationConfig, GenerativeModel, Tool
+from vertexai.preview import caching
+from vertexai.preview.generative_models import GenerativeModel as PreviewGenerativeModel
+
+from llm_cache import cached_chat
+
+MODELS_CONFIG_PATH = os.path.join(os.path.dirname(__file__), "config", "models.json")
+DEFAULT_MODEL_NAME = "gemini-2.5-flash"
+DEFAULT_CONTEXT_CACHE_TTL_S = 3600
+# First retry delay after a failed context cache create / refresh, doubled per failure up to the max
+CONTEXT_CACHE_RETRY_S = float(os.environ.get("GEMINI_CONTEXT_CACHE_RETRY_S", "60"))
+CONTEXT_CACHE_MAX_RETRY_S = float(os.environ.get("GEMINI_CONTEXT_CACHE_MAX_RETRY_S", "3600"))
+
+def load_model_settings(path: str = MODELS_CONFIG_PATH) -> Dict[str, Dict[str, Any]]:
+    """Reads config/models.json ({specialist: {"model": ..., "generation_config": {...}}})."""
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+@dataclass
+class SpecialistSpec:
+    name: str
+    system_prompt: Callable[[], Optional[str]]
+    tools: List[Tool] = field(default_factory=list)
+    model_name: str = DEFAULT_MODEL_NAME
+    generation_config: Dict[str, Any] = field(default_factory=dict)
+    context_cache: bool = False
+    context_cache_ttl_s: int = DEFAULT_CONTEXT_CACHE_TTL_S
+    response_cache: bool = False
+
+class ModelRegistry:
+    """Builds each specialist's GenerativeModel once and hands out fresh chat sessions."""
+
+    def __init__(self, settings: Optional[Dict[str, Dict[str, Any]]] = None):
+        self.settings = load_model_settings() if settings is None else settings
+        self._specs: Dict[str, SpecialistSpec] = {}
+        self._models: Dict[str, tuple] = {}  # name -> (system prompt used, GenerativeModel)
+        self._cached_contents: Dict[str, tuple] = {}  # name -> (system prompt used, CachedContent, expires_at, model)
+        self._cache_jobs = set()  # names with a context cache create / refresh in flight
+        self._cache_failures: Dict[str, tuple] = {}  # name -> (consecutive failures, retry not before)
+        self._lock = threading.Lock()
+
+    def _resolve_settings(self, name: str):
+        """models.json "default" < models.json[name] < GEMINI_MODEL_<NAME> / GEMINI_GENERATION_CONFIG_<NAME> / ..."""
+        merged = {"model": DEFAULT_MODEL_NAME, "generation_config": {}, "context_cache": {}, "response_cache": False}
+        for key in ("default", name):
+            entry = self.settings.get(key, {})
+            merged["model"] = entry.get("model", merged["model"])
+            merged["generation_config"] = {**merged["generation_config"], **entry.get("generation_config", {})}
+            merged["context_cache"] = {**merged["context_cache"], **entry.get("context_cache", {})}
+            merged["response_cache"] = entry.get("response_cache", merged["response_cache"])
+
+        env_suffix = name.upper()
+        merged["model"] = os.environ.get(f"GEMINI_MODEL_{env_suffix}", merged["model"])
+        if f"GEMINI_GENERATION_CONFIG_{env_suffix}" in os.environ:
+            merged["generation_config"].update(json.loads(os.environ[f"GEMINI_GENERATION_CONFIG_{env_suffix}"]))
+        if f"GEMINI_CONTEXT_CACHE_{env_suffix}" in os.environ:
+            merged["context_cache"]["enabled"] = os.environ[f"GEMINI_CONTEXT_CACHE_{env_suffix}"] == "1"
+        if f"GEMINI_RESPONSE_CACHE_{env_suffix}" in os.environ:
+            merged["response_cache"] = os.environ[f"GEMINI_RESPONSE_CACHE_{env_suffix}"] == "1"
+        return merged
+
+    def register(
+        self,
+        name: str,
+        system_prompt: Callable[[], Optional[str]],
+        functions: Optional[List[FunctionDeclaration]] = None,
+    ) -> SpecialistSpec:
+        """Registers a specialist. `system_prompt` is called on each use and should be cheap (cached)."""
+        settings = self._resolve_settings(name)
+        spec = SpecialistSpec(
+            name=name,
+            system_prompt=system_prompt,
+            tools=[Tool(function_declarations=functions)] if functions else [],
+            model_name=settings["model"],
+            generation_config=settings["generation_config"],
+            context_cache=settings["context_cache"].get("enabled", False),
+            context_cache_ttl_s=settings["context_cache"].get("ttl_s", DEFAULT_CONTEXT_CACHE_TTL_S),
+            response_cache=settings["response_cache"],
+        )
+        with self._lock:
+            self._specs[name] = spec
+            self._models.pop(name, None)
+        return spec
+
+    def spec(self, name: str) -> SpecialistSpec:
+        return self._specs[name]
+
+    def model(self, name: str) -> GenerativeModel:
+        """Returns the specialist's model, rebuilding it only if its system prompt changed."""
+        spec = self._specs[name]
+        system_prompt = spec.system_prompt()
+        with self._lock:
+            if spec.context_cache:
+                model = self._context_cached_model(spec, system_prompt)
+                if model is not None:
+                    return model
+
+            cached = self._models.get(name)
+            if cached is not None and cached[0] == system_prompt:
+                return cached[1]
+
+            model = GenerativeModel(
+                spec.model_name,
+                system_instruction=system_prompt,
+                tools=spec.tools or None,
+                generation_config=self._generation_config(spec),
+            )
+            self._models[name] = (system_prompt, model)
+            return model
+
+    @staticmethod
+    def _generation_config(spec: SpecialistSpec):
+        return GenerationConfig(**spec.generation_config) if spec.generation_config else None
+
+    def _context_cached_model(self, spec: SpecialistSpec, system_prompt: str):
+        """
+        Model backed by a CachedContent holding the system prompt and tools, or None while there
+        is no live cache for this prompt, so the caller falls back to sending the prompt inline.
+        Called with the lock held: it only schedules the create (first use, prompt changed, expired)
+        or the TTL extension (less than half of it left) on a background thread.
+        """
+        now = time.time()
+        entry = self._cached_contents.get(spec.name)
+        ready = entry is not None and entry[0] == system_prompt and entry[2] > now
+
+        retry_at = self._cache_failures.get(spec.name, (0, 0.0))[1]
+        if spec.name not in self._cache_jobs and now >= retry_at:
+            if not ready:
+                self._start_cache_job(spec, self._create_context_cache, spec, system_prompt, entry)
+            elif entry[2] - now < spec.context_cache_ttl_s / 2:
+                self._start_cache_job(spec, self._refresh_context_cache, spec, entry)
+
+        return entry[3] if ready else None
+
+    def _start_cache_job(self, spec: SpecialistSpec, job: Callable, *args):
+        self._cache_jobs.add(spec.name)
+        threading.Thread(
+            target=self._run_cache_job, args=(spec, job, args), name=f"context-cache-{spec.name}", daemon=True
+        ).start()
+
+    def _run_cache_job(self, spec: SpecialistSpec, job: Callable, args):
+        """Runs a create / refresh outside the lock; failures back off instead of disabling the cache."""
+        try:
+            job(*args)
+            with self._lock:
+                self._cache_failures.pop(spec.name, None)
+        except Exception as e:
+            # e.g. prompt below the minimum cacheable size, caching not enabled for the project, or a transient error
+            with self._lock:
+                failures = self._cache_failures.get(spec.name, (0, 0.0))[0] + 1
+                delay = min(CONTEXT_CACHE_RETRY_S * 2 ** (failures - 1), CONTEXT_CACHE_MAX_RETRY_S)
+                self._cache_failures[spec.name] = (failures, time.time() + delay)
+            print(f"    [Model Registry] Context cache unavailable for {spec.name}, sending prompt inline "
+                  f"(retry in {delay:.0f}s): {e}")
+        finally:
+            with self._lock:
+                self._cache_jobs.discard(spec.name)
+
+    def _create_context_cache(self, spec: SpecialistSpec, system_prompt: str, stale: Optional[tuple]):
+        if stale is not None and stale[0] != system_prompt:
+            # Prompt changed (config edited): drop the stale cache instead of waiting for its TTL
+            try:
+                stale[1].delete()
+            except Exception:
+                pass
+        cached_content = caching.CachedContent.create(
+            model_name=spec.model_name,
+            system_instruction=system_prompt,
+            tools=spec.tools or None,
+            ttl=datetime.timedelta(seconds=spec.context_cache_ttl_s),
+            display_name=f"resilitix-{spec.name}",
+        )
+        model = PreviewGenerativeModel.from_cached_content(
+            cached_content=cached_content,
+            generation_config=self._generation_config(spec),
+        )
+        print(f"    [Model Registry] Created context cache for {spec.name}: {cached_content.name}")
+        with self._lock:
+            self._cached_contents[spec.name] = (
+                system_prompt, cached_content, time.time() + spec.context_cache_ttl_s, model
+            )
+
+    def _refresh_context_cache(self, spec: SpecialistSpec, entry: tuple):
+        entry[1].update(ttl=datetime.timedelta(seconds=spec.context_cache_ttl_s))
+        with self._lock:
+            # Only extend the entry that was refreshed (a create may have replaced it meanwhile)
+            if self._cached_contents.get(spec.name, (None, None))[1] is entry[1]:
+                self._cached_contents[spec.name] = (entry[0], entry[1], time.time() + spec.context_cache_ttl_s, entry[3])
+
+    def start_chat(self, name: str, history=None) -> ChatSession:
+        """Fresh chat session on the shared model (behind the response cache if the specialist opts in)."""
+        chat = self.model(name).start_chat(history=history)
+        spec = self._specs[name]
+        if spec.response_cache:
+            chat = cached_chat(chat, spec.model_name, spec.system_prompt(), spec.tools, spec.generation_config)
+        return chat
+
+# Process-wide registry
+registry = ModelRegistry()
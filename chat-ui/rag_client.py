@@ -0,0 +1,160 @@
+"""
+Shared Vertex AI Search (Discovery Engine) client.
+
+One SearchServiceClient (one gRPC channel) per process instead of one per
+search, plus an LRU/TTL cache of search summaries keyed by serving config and
+normalized query. Used by app.py, graph.py and test_agents.py.
+"""
+
+import asyncio
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Optional
+
+from google.cloud import discoveryengine_v1 as discoveryengine
+
+from tracing import traced
+
+# --- CONFIGURATION ---
+PROJECT_ID = os.environ.get("RAG_PROJECT_ID", "resiliencegenomeai")
+RAG_DATA_STORE_ID = os.environ.get("RAG_DATA_STORE_ID", "resilitix-rag-data_1765252053186")
+SERVING_CONFIG_ID = "default_search"
+API_ENDPOINT = "discoveryengine.googleapis.com"
+
+RAG_CACHE_SIZE = int(os.environ.get("RAG_CACHE_SIZE", "256"))
+RAG_CACHE_TTL_S = float(os.environ.get("RAG_CACHE_TTL_S", "3600"))
+
+def normalize_query(query: str) -> str:
+    """Cache key form of a search query: case and whitespace insensitive."""
+    return " ".join(query.lower().split())
+
+class SummaryCache:
+    """Thread-safe LRU cache with a per-entry TTL."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires_at, summary)
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, summary: str):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, summary)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+class RagClient:
+    """Process-wide Discovery Engine search client with a summary cache."""
+
+    def __init__(self, project_id: str = PROJECT_ID, data_store_id: str = RAG_DATA_STORE_ID,
+                 serving_config_id: str = SERVING_CONFIG_ID):
+        self.client_options = {"api_endpoint": API_ENDPOINT}
+        self.serving_config = discoveryengine.SearchServiceClient.serving_config_path(
+            project=project_id, location="global", data_store=data_store_id, serving_config=serving_config_id,
+        )
+        self.cache = SummaryCache(RAG_CACHE_SIZE, RAG_CACHE_TTL_S)
+        self._client = None
+        self._client_lock = threading.Lock()
+        # gRPC asyncio channels are bound to the event loop that created them
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    @property
+    def client(self) -> discoveryengine.SearchServiceClient:
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = discoveryengine.SearchServiceClient(client_options=self.client_options)
+        return self._client
+
+    def async_client(self) -> discoveryengine.SearchServiceAsyncClient:
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = discoveryengine.SearchServiceAsyncClient(client_options=self.client_options)
+            self._async_clients[loop] = client
+        return client
+
+    def _request(self, query: str) -> discoveryengine.SearchRequest:
+        return discoveryengine.SearchRequest(
+            serving_config=self.serving_config, query=query, page_size=5,
+            content_search_spec=discoveryengine.SearchRequest.ContentSearchSpec(
+                summary_spec=discoveryengine.SearchRequest.ContentSearchSpec.SummarySpec(summary_result_count=5)
+            )
+        )
+
+    @staticmethod
+    def _summary(response) -> str:
+        if (response.summary and
+            response.summary.summary_with_metadata and
+            response.summary.summary_with_metadata.summary):
+            return response.summary.summary_with_metadata.summary
+        return ""
+
+    def _cache_key(self, query: str):
+        return (self.serving_config, normalize_query(query))
+
+    def search_summary(self, query: str) -> str:
+        """Returns the generated summary for `query` ("" if none). Raises on API errors."""
+        key = self._cache_key(query)
+        summary = self.cache.get(key)
+        if summary is None:
+            summary = self._summary(self.client.search(self._request(query)))
+            self.cache.set(key, summary)
+        return summary
+
+    async def search_summary_async(self, query: str) -> str:
+        """Async variant of search_summary (shares the same cache)."""
+        key = self._cache_key(query)
+        summary = self.cache.get(key)
+        if summary is None:
+            summary = self._summary(await self.async_client().search(self._request(query)))
+            self.cache.set(key, summary)
+        return summary
+
+# --- PROCESS-WIDE CLIENT ---
+_client = None
+_client_lock = threading.Lock()
+
+def get_client() -> RagClient:
+    """Returns the shared RAG client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = RagClient()
+    return _client
+
+@traced("execute_rag_search")
+def execute_rag_search(query: str) -> dict:
+    """Raw helper to hit Vertex AI Search."""
+    try:
+        summary = get_client().search_summary(query)
+        return {"summary": summary, "found": bool(summary)}
+    except Exception as e:
+        return {"error": str(e)}
+
+@traced("execute_rag_search")
+async def execute_rag_search_async(query: str) -> dict:
+    """Async helper to hit Vertex AI Search (native gRPC asyncio client)."""
+    try:
+        summary = await get_client().search_summary_async(query)
+        return {"summary": summary, "found": bool(summary)}
+    except Exception as e:
+        return {"error": str(e)}
@@ -0,0 +1,154 @@
+"""
+Semantic question -> SQL cache for the Text-to-SQL agent.
+
+Questions are embedded with a Vertex AI text embedding model and kept in an
+in-memory cosine-similarity index (a normalized numpy matrix). A new question
+whose nearest neighbour scores above SEMANTIC_CACHE_THRESHOLD reuses that
+entry's validated SQL directly, skipping the LLM conversation.
+
+Near-duplicate wording is not enough on its own: "hospitals in Harris County"
+and "hospitals in Dallas County" embed very closely. An entry is only reused
+when the numbers, county and state names in both questions match exactly.
+"""
+
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import FrozenSet, List, Optional, Tuple
+
+import numpy as np
+from vertexai.language_models import TextEmbeddingModel
+
+# --- CONFIGURATION ---
+SEMANTIC_CACHE_ENABLED = os.environ.get("SEMANTIC_CACHE", "1") == "1"
+SEMANTIC_CACHE_MODEL = os.environ.get("SEMANTIC_CACHE_MODEL", "text-embedding-005")
+# Minimum cosine similarity for a question to reuse cached SQL
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.93"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", "1000"))
+SEMANTIC_CACHE_TTL_S = float(os.environ.get("SEMANTIC_CACHE_TTL_S", str(24 * 3600)))
+
+_NUMBER_RE = re.compile(r"\d+(?:\.\d+)?")
+_COUNTY_RE = re.compile(r"([A-Za-z][A-Za-z .'-]*?)\s+(?:county|parish)\b", re.IGNORECASE)
+_STATE_RE = re.compile(
+    r"\b(alabama|alaska|arizona|arkansas|california|colorado|connecticut|delaware|florida|georgia|hawaii|idaho|"
+    r"illinois|indiana|iowa|kansas|kentucky|louisiana|maine|maryland|massachusetts|michigan|minnesota|"
+    r"mississippi|missouri|montana|nebraska|nevada|new hampshire|new jersey|new mexico|new york|"
+    r"north carolina|north dakota|ohio|oklahoma|oregon|pennsylvania|rhode island|south carolina|south dakota|"
+    r"tennessee|texas|utah|vermont|virginia|washington|west virginia|wisconsin|wyoming)\b",
+    re.IGNORECASE,
+)
+# Words that can precede a county name in a question
+_LEAD_WORDS = {"in", "of", "for", "the", "and", "across", "within", "near", "from", "to"}
+
+def question_entities(question: str) -> FrozenSet[str]:
+    """Numbers (zip codes, thresholds, years), county and state names that must match for a cache hit."""
+    entities = set(_NUMBER_RE.findall(question))
+    entities.update(s.lower() for s in _STATE_RE.findall(question))
+    for mention in _COUNTY_RE.findall(question):
+        # Last two words of the phrase before "County", minus leading filler ("in Harris" -> "harris")
+        words = [w.lower() for w in mention.split()[-2:]]
+        while words and words[0] in _LEAD_WORDS:
+            words.pop(0)
+        entities.add("county:" + " ".join(words))
+    return frozenset(entities)
+
+@dataclass
+class CacheEntry:
+    question: str
+    sql: str
+    entities: FrozenSet[str]
+    created_at: float = field(default_factory=time.time)
+    last_used: float = field(default_factory=time.time)
+    hits: int = 0
+
+class SemanticSQLCache:
+    """Thread-safe nearest-neighbour cache with TTL and least-recently-used eviction."""
+
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD, max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES,
+                 ttl: float = SEMANTIC_CACHE_TTL_S, model_name: str = SEMANTIC_CACHE_MODEL):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.model_name = model_name
+        self.entries: List[CacheEntry] = []
+        self._vectors = None  # (n, dim) float32, rows L2-normalized
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self) -> TextEmbeddingModel:
+        if self._model is None:
+            self._model = TextEmbeddingModel.from_pretrained(self.model_name)
+        return self._model
+
+    @staticmethod
+    def _normalize(values) -> np.ndarray:
+        vector = np.asarray(values, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def embed(self, question: str) -> np.ndarray:
+        return self._normalize(self.model.get_embeddings([question])[0].values)
+
+    async def embed_async(self, question: str) -> np.ndarray:
+        return self._normalize((await self.model.get_embeddings_async([question]))[0].values)
+
+    def _drop(self, keep: np.ndarray):
+        self.entries = [e for e, k in zip(self.entries, keep) if k]
+        self._vectors = self._vectors[keep] if self.entries else None
+
+    def lookup_vector(self, question: str, vector: np.ndarray) -> Optional[Tuple[CacheEntry, float]]:
+        """Best entry above the threshold whose entities match, with its similarity."""
+        with self._lock:
+            if self._vectors is None:
+                return None
+            now = time.time()
+            expired = np.array([e.created_at + self.ttl < now for e in self.entries])
+            if expired.any():
+                self._drop(~expired)
+                if self._vectors is None:
+                    return None
+
+            scores = self._vectors @ vector
+            entities = question_entities(question)
+            for i in np.argsort(-scores):
+                if scores[i] < self.threshold:
+                    break
+                entry = self.entries[i]
+                if entry.entities == entities:
+                    entry.hits += 1
+                    entry.last_used = now
+                    return entry, float(scores[i])
+            return None
+
+    def add_vector(self, question: str, sql: str, vector: np.ndarray):
+        """Stores a validated question -> SQL pair, evicting the least recently used entry when full."""
+        entry = CacheEntry(question=question, sql=sql, entities=question_entities(question))
+        with self._lock:
+            if self.entries and len(self.entries) >= self.max_entries:
+                lru = int(np.argmin([e.last_used for e in self.entries]))
+                self._drop(np.arange(len(self.entries)) != lru)
+            self.entries.append(entry)
+            row = vector[np.newaxis, :]
+            self._vectors = row if self._vectors is None else np.vstack([self._vectors, row])
+
+    def invalidate(self, sql: str):
+        """Drops entries whose SQL stopped working (e.g. schema change)."""
+        with self._lock:
+            if self._vectors is not None:
+                self._drop(np.array([e.sql != sql for e in self.entries]))
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache() -> Optional[SemanticSQLCache]:
+    """Shared cache, or None when SEMANTIC_CACHE=0."""
+    global _cache
+    if not SEMANTIC_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = SemanticSQLCache()
+    return _cache
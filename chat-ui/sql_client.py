@@ -0,0 +1,228 @@
+"""
+Shared client for the Cloud Run SQL tool.
+
+One pooled keep-alive HTTP session per process, ID tokens cached until shortly
+before they expire, bounded timeouts and retry with backoff. Used by app.py,
+graph.py and test_agents.py.
+"""
+
+import asyncio
+import base64
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, Optional
+
+import google.auth.transport.requests
+import google.oauth2.id_token
+import pyarrow as pa
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from tracing import inject_headers, span
+
+# --- CONFIGURATION ---
+TOOL_URL = os.environ.get("SQL_TOOL_URL", "https://resilitix-sql-tool-525917099044.us-central1.run.app")
+
+CONNECT_TIMEOUT_S = float(os.environ.get("SQL_TOOL_CONNECT_TIMEOUT_S", "5"))
+READ_TIMEOUT_S = float(os.environ.get("SQL_TOOL_READ_TIMEOUT_S", "120"))
+MAX_RETRIES = int(os.environ.get("SQL_TOOL_MAX_RETRIES", "3"))
+BACKOFF_FACTOR = float(os.environ.get("SQL_TOOL_BACKOFF_FACTOR", "0.5"))
+POOL_SIZE = int(os.environ.get("SQL_TOOL_POOL_SIZE", "16"))
+
+# Refresh the ID token this many seconds before it expires
+TOKEN_REFRESH_MARGIN_S = 300
+
+JSON_MIMETYPE = "application/json"
+NDJSON_MIMETYPE = "application/x-ndjson"
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+
+def _token_expiry(token: str) -> float:
+    """Reads the `exp` claim from a JWT without verifying it (we only need it for caching)."""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        # Unknown expiry: treat as short-lived
+        return time.time() + TOKEN_REFRESH_MARGIN_S + 60
+
+def _http_error(response: requests.Response) -> str:
+    """Error text for a non-200 tool response: the tool's {"error": ...} message when it sent one."""
+    try:
+        return f"HTTP {response.status_code} Error: {response.json()['error']}"
+    except Exception:
+        return f"HTTP {response.status_code} Error. Raw response: {response.text}"
+
+class SQLToolClient:
+    """Keep-alive, token-caching HTTP client for the SQL tool."""
+
+    def __init__(self, url: str = TOOL_URL):
+        self.url = url
+        self.timeout = (CONNECT_TIMEOUT_S, READ_TIMEOUT_S)
+
+        # Retry only on connect errors and on 429 / 503, which Cloud Run returns when no instance took
+        # the request. Never on read errors, 502 (instance died mid-request) or 504 (request timeout):
+        # the query may still be running (and billing), so resubmitting it would start another job.
+        # A 500 from the tool is a BigQuery error
+        retry = Retry(
+            total=MAX_RETRIES,
+            connect=MAX_RETRIES,
+            read=0,
+            backoff_factor=BACKOFF_FACTOR,
+            status_forcelist=[429, 503],
+            allowed_methods=["POST", "GET"],
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._auth_request = google.auth.transport.requests.Request(session=requests.Session())
+        self._token = None
+        self._token_expiry = 0.0
+        self._token_lock = threading.Lock()
+
+    def get_id_token(self, force_refresh: bool = False) -> str:
+        """Returns a cached Google ID token for the tool, minting a new one near expiry."""
+        with self._token_lock:
+            if force_refresh or self._token is None or time.time() > self._token_expiry - TOKEN_REFRESH_MARGIN_S:
+                with span("sql_tool.id_token"):
+                    self._token = google.oauth2.id_token.fetch_id_token(self._auth_request, self.url)
+                self._token_expiry = _token_expiry(self._token)
+            return self._token
+
+    def post_query(self, query: str, accept: str = JSON_MIMETYPE, stream: bool = False,
+                   options: Optional[Dict[str, Any]] = None) -> requests.Response:
+        """
+        POSTs a query (plus request `options`, e.g. check) to the tool. Retries once with a fresh token on 401.
+        The current trace context travels in the traceparent header. With stream=True the span ends
+        once the headers arrive; the body download is timed by the caller's span.
+        """
+        payload = json.dumps({"query": query, **(options or {})})
+        with span("sql_tool.post", accept=accept, check=bool((options or {}).get("check"))) as current:
+            for attempt in range(2):
+                headers = inject_headers({
+                    'Content-Type': 'application/json',
+                    'Accept': accept,
+                    'Authorization': f'Bearer {self.get_id_token(force_refresh=attempt > 0)}'
+                })
+                response = self.session.post(self.url, data=payload, headers=headers, timeout=self.timeout, stream=stream)
+                current.set_attribute("http.status_code", response.status_code)
+                if response.status_code != 401:
+                    return response
+                response.close()
+            return response
+
+    def iter_rows(self, query: str, options: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Streams rows as NDJSON, yielding each row as soon as it arrives.
+        Raises RuntimeError on HTTP errors or if the tool reports a failure mid-stream.
+        """
+        with self.post_query(query, accept=NDJSON_MIMETYPE, stream=True, options=options) as response:
+            if response.status_code != 200:
+                raise RuntimeError(_http_error(response))
+
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                row = json.loads(line)
+                if "__error__" in row:
+                    raise RuntimeError(f"Stream interrupted: {row['__error__']}")
+                yield row
+
+    def execute(self, query: str, options: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Runs a query (with request `options`, e.g. check) and returns {"data": [...]} or {"error": "..."}."""
+        try:
+            return {"data": list(self.iter_rows(query, options))}
+        except json.JSONDecodeError as e:
+            return {"error": f"Invalid JSON received: {str(e)}"}
+        except RuntimeError as e:
+            return {"error": str(e)}
+        except Exception as e:
+            return {"error": f"Connection Exception: {str(e)}"}
+
+    def fetch_dataframe(self, query: str):
+        """
+        Requests the result as an Arrow IPC stream and decodes it into a DataFrame.
+        Columns keep their BigQuery types. Raises RuntimeError on HTTP errors.
+        """
+        response = self.post_query(query, accept=ARROW_MIMETYPE)
+        if response.status_code != 200:
+            raise RuntimeError(_http_error(response))
+
+        with pa.ipc.open_stream(response.content) as reader:
+            return reader.read_all().to_pandas()
+
+# --- PROCESS-WIDE CLIENT ---
+_client = None
+_client_lock = threading.Lock()
+
+def get_client() -> SQLToolClient:
+    """Returns the shared client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = SQLToolClient()
+    return _client
+
+_executor = None
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Worker threads for the async helpers, one per pooled connection. The loop's default
+    executor is shared with everything else and smaller on small machines.
+    """
+    global _executor
+    if _executor is None:
+        with _client_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="sql-tool")
+    return _executor
+
+async def _run_blocking(fn, *args):
+    """Runs a blocking call on the SQL tool executor, in a copy of the caller's context (trace spans, event sink)."""
+    call = functools.partial(contextvars.copy_context().run, fn, *args)
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), call)
+
+def iter_bigquery_rows(query: str) -> Iterator[Dict[str, Any]]:
+    """Streams rows from the SQL tool using the shared client."""
+    return get_client().iter_rows(query)
+
+def execute_bigquery_request(query: str, options: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Raw helper to hit the Cloud Run SQL Tool and get data."""
+    print(f"    [Execution] Sending SQL to Cloud Run: {query[:80]}...")
+    with span("execute_bigquery_request") as current:
+        result = get_client().execute(query, options)
+        current.set_attribute("rows", len(result.get("data", [])))
+        current.set_attribute("error", "error" in result)
+        return result
+
+async def execute_bigquery_request_async(query: str) -> Dict[str, Any]:
+    """
+    Async variant of execute_bigquery_request. The blocking HTTP call runs on the SQL tool
+    executor (sized like the connection pool) over the shared session, so the event loop stays free.
+    """
+    return await _run_blocking(execute_bigquery_request, query)
+
+def execute_checked_bigquery_request(query: str) -> Dict[str, Any]:
+    """
+    Executes a query behind the tool's dry-run gate ("check"), in a single request: broken or
+    runaway SQL comes back as an error before it costs anything, and cached results skip the dry run.
+    """
+    return execute_bigquery_request(query, options={"check": True})
+
+async def execute_checked_bigquery_request_async(query: str) -> Dict[str, Any]:
+    """Async variant of execute_checked_bigquery_request (SQL tool executor, shared session)."""
+    return await _run_blocking(execute_checked_bigquery_request, query)
+
+def fetch_bigquery_dataframe(query: str):
+    """Fetches a query result as a typed DataFrame using the shared client."""
+    return get_client().fetch_dataframe(query)
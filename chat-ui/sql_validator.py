@@ -0,0 +1,143 @@
+"""
+Local pre-validation of generated SQL against the DDL in config/instructions.md.
+
+The CREATE TABLE statements in the data dictionary are parsed once into a
+catalog (table -> columns), rebuilt only when the config files change. Generated
+SQL is then checked in-process for unknown tables (hyphen / underscore mixups),
+unknown alias.column references and hyphenated table names left unquoted, so
+those mistakes go back to the model without a round trip to BigQuery.
+
+Offline checks: python -m doctest sql_validator.py
+"""
+
+import difflib
+import os
+import re
+import threading
+from typing import Dict, List, Optional
+
+from config_registry import registry as config_registry
+
+# Set SQL_VALIDATOR=0 to skip local validation
+SQL_VALIDATOR_ENABLED = os.environ.get("SQL_VALIDATOR", "1") == "1"
+
+DATASET = "data_library"
+
+_CREATE_TABLE_RE = re.compile(
+    r"CREATE\s+TABLE\s+" + DATASET + r"\.(`[^`]+`|[\w-]+)\s*\((.*?)\)\s*;", re.IGNORECASE | re.DOTALL
+)
+# String literals and comments are blanked before scanning identifiers
+_LITERAL_RE = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|--[^\n]*|#[^\n]*|/\*.*?\*/", re.DOTALL)
+# data_library.table, data_library.`table` or `data_library.table`, optionally with a project
+# prefix inside the same backticks (`project.data_library.table`)
+_TABLE_REF_RE = re.compile(
+    r"(`?)(?:[\w-]+\.)?" + DATASET + r"\.(?:`([^`]+)`|([\w-]+))(`?)(?:\s+(?:AS\s+)?(\w+))?", re.IGNORECASE
+)
+_QUALIFIED_COLUMN_RE = re.compile(r"(?<![\w.`])(\w+)\.(\w+)\b")
+_FROM_JOIN_RE = re.compile(r"\b(?:FROM|JOIN)\s*$", re.IGNORECASE)
+
+# Words that may follow a table reference but are not aliases
+_NOT_ALIASES = {
+    "on", "using", "where", "join", "inner", "left", "right", "full", "cross", "outer", "group", "order",
+    "limit", "union", "having", "window", "qualify", "select", "from", "as", "and", "or", "tablesample",
+}
+
+def parse_ddl(text: str) -> Dict[str, Dict[str, str]]:
+    """CREATE TABLE statements -> {table name: {column name: type}}."""
+    catalog = {}
+    for m in _CREATE_TABLE_RE.finditer(text):
+        table = m.group(1).strip("`")
+        columns = {}
+        for column_def in m.group(2).split(","):
+            parts = column_def.split()
+            if len(parts) >= 2:
+                columns[parts[0].strip("`")] = parts[1].upper()
+        catalog[table] = columns
+    return catalog
+
+_catalog = None
+_catalog_version = None
+_catalog_lock = threading.Lock()
+
+def get_catalog() -> Dict[str, Dict[str, str]]:
+    """Schema catalog from instructions.md, parsed once per config version."""
+    global _catalog, _catalog_version
+    with _catalog_lock:
+        version = config_registry.version()
+        if _catalog is None or version != _catalog_version:
+            _catalog = parse_ddl(config_registry.instructions(default=""))
+            _catalog_version = version
+        return _catalog
+
+def _suggest(name: str, candidates) -> str:
+    """Closest known names, treating '-' and '_' as the same character."""
+    by_key = {c.lower().replace("-", "_"): c for c in candidates}
+    matches = difflib.get_close_matches(name.lower().replace("-", "_"), list(by_key), n=3, cutoff=0.6)
+    return f" Did you mean: {', '.join(by_key[m] for m in matches)}?" if matches else ""
+
+def validate_sql(sql: str, catalog: Optional[Dict[str, Dict[str, str]]] = None) -> List[str]:
+    """
+    Problems found in `sql` (empty list if none, or if no catalog is available).
+
+    >>> catalog = {"OOKLA-FIX-DL": {"hex_id": "STRING"}}
+    >>> validate_sql("SELECT t.hex_id FROM `resiliencegenomeai.data_library.OOKLA-FIX-DL` t", catalog)
+    []
+    >>> validate_sql("SELECT t.hex_id FROM data_library.`OOKLA-FIX-DL` AS t", catalog)
+    []
+    >>> validate_sql("SELECT t.speed FROM `resiliencegenomeai.data_library.OOKLA-FIX-DL` t", catalog)
+    ['Column t.speed does not exist in data_library.`OOKLA-FIX-DL`. Columns: hex_id.']
+    >>> validate_sql("SELECT 1 WHERE x IN (SELECT * FROM t) AND y = data_library.OOKLA-FIX-DL", catalog)
+    ['Hyphenated table names must be quoted: data_library.`OOKLA-FIX-DL`.']
+    """
+    catalog = get_catalog() if catalog is None else catalog
+    if not catalog:
+        return []
+
+    tables_lower = {t.lower(): t for t in catalog}
+    scrubbed = _LITERAL_RE.sub("''", sql)
+    errors = []
+    aliases = {}  # alias (lower case) -> table
+
+    for m in _TABLE_REF_RE.finditer(scrubbed):
+        open_tick, quoted, bare, close_tick, alias = m.groups()
+        table = quoted or bare
+        if table.upper().startswith("INFORMATION_SCHEMA"):
+            continue
+
+        if table not in catalog:
+            if table.lower() in tables_lower:
+                errors.append(f"Table names are case sensitive: use `{tables_lower[table.lower()]}` instead of `{table}`.")
+                table = tables_lower[table.lower()]
+            else:
+                errors.append(f"Unknown table {DATASET}.{table}.{_suggest(table, catalog)}")
+                continue
+
+        # Unquoted dashes are only legal in a FROM / JOIN table path
+        if bare and "-" in bare and not open_tick and not _FROM_JOIN_RE.search(scrubbed[:m.start()]):
+            errors.append(f"Hyphenated table names must be quoted: {DATASET}.`{table}`.")
+
+        if alias and alias.lower() not in _NOT_ALIASES:
+            aliases[alias.lower()] = table
+        aliases[table.lower()] = table
+
+    for qualifier, column in _QUALIFIED_COLUMN_RE.findall(scrubbed):
+        table = aliases.get(qualifier.lower())
+        # Column names are case insensitive in BigQuery
+        if table is None or column.lower() in {c.lower() for c in catalog[table]}:
+            continue
+        errors.append(
+            f"Column {qualifier}.{column} does not exist in {DATASET}.`{table}`. "
+            f"Columns: {', '.join(catalog[table])}.{_suggest(column, catalog[table])}"
+        )
+
+    return list(dict.fromkeys(errors))
+
+def validation_error(sql: str) -> Optional[Dict[str, str]]:
+    """Tool-style {"error": ...} for SQL that fails local validation, or None if it looks valid."""
+    if not SQL_VALIDATOR_ENABLED:
+        return None
+    errors = validate_sql(sql)
+    if not errors:
+        return None
+    print(f"    [SQL Validator] Rejected SQL: {errors}")
+    return {"error": "Query rejected by schema validation (not executed): " + " ".join(errors)}
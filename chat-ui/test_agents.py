@@ -2,13 +2,15 @@
 
 import vertexai
 from vertexai.generative_models import GenerativeModel, Tool, Part, Content, ChatSession, FunctionDeclaration
-import requests
 import json
-import google.auth.transport.requests
-import google.oauth2.id_token
 import os
-from google.cloud import discoveryengine_v1 as discoveryengine
 from typing import Dict, Any
+from config_registry import load_config
+from sql_client import execute_checked_bigquery_request
+from rag_client import execute_rag_search
+from tool_loop import run_tool_loop
+from sql_validator import validation_error
+from llm_cache import cached_chat
 
 # --- GLOBAL CONTEXT STORE (Simulating st.session_state for CLI) ---
 _CONTEXT_STORE = {
@@ -18,86 +20,10 @@ _CONTEXT_STORE = {
 # --- CONFIGURATION ---
 PROJECT_ID = "resiliencegenomeai"
 LOCATION = "us-central1"
-TOOL_URL = "https://resilitix-sql-tool-525917099044.us-central1.run.app"
-RAG_DATA_STORE_ID = "resilitix-rag-data_1765252053186" 
 
 # Initialize Vertex AI
 vertexai.init(project=PROJECT_ID, location=LOCATION)
 
-# --- HELPER: GET AUTH TOKEN ---
-def get_id_token(url: str) -> str:
-    """Generates a Google ID Token to authenticate with the Cloud Run tool."""
-    auth_req = google.auth.transport.requests.Request()
-    return google.oauth2.id_token.fetch_id_token(auth_req, url)
-
-# --- HELPER: LOAD CONFIGURATION ---
-def load_config():
-    """Reads instructions.md and examples.json to build the context string."""
-    # 1. Load Rules
-    try:
-        config_path = os.path.join(os.path.dirname(__file__), "config", "instructions.md")
-        with open(config_path, "r") as f:
-            base_instructions = f.read()
-    except FileNotFoundError:
-        base_instructions = "You are a helpful data assistant."
-
-    # 2. Load Examples
-    try:
-        examples_path = os.path.join(os.path.dirname(__file__), "config", "examples.json")
-        with open(examples_path, "r") as f:
-            examples_data = json.load(f)
-            examples_text = "\n\n### SQL Few-Shot Examples:\n"
-            for ex in examples_data:
-                examples_text += f"User: {ex['question']}\nSQL: {ex['sql']}\n\n"
-    except FileNotFoundError:
-        examples_text = ""
-    
-    return base_instructions + "\n" + examples_text
-
-# --- LOW-LEVEL HELPERS ---
-def execute_bigquery_request(query: str) -> Dict[str, Any]:
-    """Raw helper to hit the Cloud Run SQL Tool and get data."""
-    print(f"    [Execution] Sending SQL to Cloud Run: {query[:80]}...")
-    payload = json.dumps({"query": query})
-    try:
-        token = get_id_token(TOOL_URL)
-        headers = {'Content-Type': 'application/json', 'Authorization': f'Bearer {token}'}
-        response = requests.post(TOOL_URL, data=payload, headers=headers)
-        
-        if response.status_code != 200:
-            return {"error": f"HTTP {response.status_code} Error. Raw response: {response.text}"}
-        
-        try:
-            return response.json()
-        except json.JSONDecodeError:
-            return {"error": f"Invalid JSON received. Raw content: {response.text}"}
-    except Exception as e:
-        return {"error": f"Connection Exception: {str(e)}"}
-
-def execute_rag_search(query: str) -> Dict[str, Any]:
-    """Raw helper to hit Vertex AI Search."""
-    try:
-        client_options = {"api_endpoint": "discoveryengine.googleapis.com"}
-        client = discoveryengine.SearchServiceClient(client_options=client_options)
-        serving_config = client.serving_config_path(
-            project=PROJECT_ID, location="global", data_store=RAG_DATA_STORE_ID, serving_config="default_search",
-        )
-        request = discoveryengine.SearchRequest(
-            serving_config=serving_config, query=query, page_size=5,
-            content_search_spec=discoveryengine.SearchRequest.ContentSearchSpec(
-                summary_spec=discoveryengine.SearchRequest.ContentSearchSpec.SummarySpec(summary_result_count=5)
-            )
-        )
-        response = client.search(request)
-        
-        summary = ""
-        if response.summary and response.summary.summary_with_metadata:
-             summary = response.summary.summary_with_metadata.summary
-             
-        return {"summary": summary, "found": bool(summary)}
-    except Exception as e:
-        return {"error": str(e)}
-
 # --- AGENT SPECIALISTS ---
 
 def agent_text_to_sql(user_query: str) -> Dict[str, Any]:
@@ -130,55 +56,34 @@ def agent_text_to_sql(user_query: str) -> Dict[str, Any]:
     """
 
     model = GenerativeModel("gemini-2.5-flash", system_instruction=system_prompt, tools=[sql_tool])
-    chat = model.start_chat()
-    
-    response = chat.send_message(user_query)
+    # Repeated runs of the same turn can be answered from the on-disk response cache (LLM_CACHE=on)
+    chat = cached_chat(model.start_chat(), "gemini-2.5-flash", system_prompt, [sql_tool])
     
     final_output = {"error": "SQL Agent could not process request."}
+
+    def run_sql(args):
+        sql_q = args["query"]
+        print(f"    [Agent A: SQL] Generated SQL: {sql_q}")
+        
+        # Execute SQL
+        return validation_error(sql_q) or execute_checked_bigquery_request(sql_q)
     
     # --- RETRY LOOP FOR SQL AGENT ---
-    # We loop up to 5 times to allow the model to fix bad SQL or refine results
-    # for _ in range(5):
-    while True:
-        try:
-            # Check if we have a response content
-            if not response.candidates:
-                break
-
-            part = response.candidates[0].content.parts[0]
-
-            # If it's just text (no tool call), we assume the agent is done or asking for clarification
-            if not part.function_call:
-                break
-
-            # Handle Tool Call
-            fn = part.function_call
-            if fn.name == "run_sql":
-                sql_q = fn.args["query"]
-                print(f"    [Agent A: SQL] Generated SQL: {sql_q}")
-                
-                # Execute SQL
-                data_result = execute_bigquery_request(sql_q)
-                
-                # Prepare Result
-                full_result = {
-                    "request": user_query,
-                    "generated_sql": sql_q,
-                    "execution_result": data_result
-                }
-                
-                # Store context globally for the Map Agent to use later
-                _CONTEXT_STORE["last_sql_context"] = full_result
-                final_output = full_result
-
-                # Send result back to Model (This allows the loop to continue or finish)
-                response = chat.send_message(
-                    Part.from_function_response(name="run_sql", response={"content": data_result})
-                )
-
-        except Exception as e:
-            final_output = {"error": f"SQL Agent Internal Error: {e}"}
-            break
+    # Bounded by the shared tool loop (turns, time and token budgets)
+    try:
+        loop = run_tool_loop(chat, user_query, {"run_sql": run_sql}, name="Agent A: SQL")
+        # The last query issued (call order, not completion order) is the answer
+        call = loop.last_call("run_sql")
+        if call is not None:
+            final_output = {
+                "request": user_query,
+                "generated_sql": call.args["query"],
+                "execution_result": call.result
+            }
+            # Store context globally for the Map Agent to use later
+            _CONTEXT_STORE["last_sql_context"] = final_output
+    except Exception as e:
+        final_output = {"error": f"SQL Agent Internal Error: {e}"}
 
     return final_output
 
@@ -202,25 +107,23 @@ def agent_rag(user_query: str) -> Dict[str, Any]:
     """
     
     model = GenerativeModel("gemini-2.5-flash", system_instruction=system_prompt, tools=[rag_tool])
-    chat = model.start_chat()
+    # Repeated runs of the same turn can be answered from the on-disk response cache (LLM_CACHE=on)
+    chat = cached_chat(model.start_chat(), "gemini-2.5-flash", system_prompt, [rag_tool])
     
-    response = chat.send_message(user_query)
+    def run_search(args):
+        q = args["query"]
+        print(f"    [Agent B: RAG] Search Query: {q}")
+        return execute_rag_search(q)
+
     final_answer = {"text": "RAG Agent found no information."}
 
     try:
         # Simple single-turn loop for RAG usually suffices
-        while response.candidates[0].content.parts[0].function_call:
-            fn = response.candidates[0].content.parts[0].function_call
-            if fn.name == "search_knowledge_base":
-                q = fn.args["query"]
-                print(f"    [Agent B: RAG] Search Query: {q}")
-                
-                search_result = execute_rag_search(q)
-                
-                response = chat.send_message(
-                    Part.from_function_response(name="search_knowledge_base", response={"content": search_result})
-                )
-                final_answer = {"text": response.text, "search_summary": search_result}
+        loop = run_tool_loop(chat, user_query, {"search_knowledge_base": run_search},
+                             name="Agent B: RAG", max_turns=3)
+        search = loop.last_call("search_knowledge_base")
+        if search is not None:
+            final_answer = {"text": loop.text, "search_summary": search.result}
                 
     except Exception as e:
         final_answer = {"error": f"RAG Agent Internal Error: {e}"}
@@ -260,40 +163,30 @@ def agent_mapping(user_query: str) -> Dict[str, Any]:
     """
 
     model = GenerativeModel("gemini-2.5-flash", system_instruction=system_prompt, tools=[map_tool])
-    chat = model.start_chat()
+    # Repeated runs of the same turn can be answered from the on-disk response cache (LLM_CACHE=on)
+    chat = cached_chat(model.start_chat(), "gemini-2.5-flash", system_prompt, [map_tool])
     
-    response = chat.send_message(user_query)
     final_output = {"error": "Mapping Agent could not process request."}
 
+    def run_map_sql(args):
+        sql_q = args["query"]
+        print(f"    [Agent C: Mapping] Generated SQL: {sql_q}")
+        
+        return validation_error(sql_q) or execute_checked_bigquery_request(sql_q)
+
     # Retry loop for Mapping Agent as well (in case SQL fails)
-    for _ in range(5):
-        try:
-            if not response.candidates: break
-            part = response.candidates[0].content.parts[0]
-            if not part.function_call: break
-
-            fn = part.function_call
-            if fn.name == "run_map_sql":
-                sql_q = fn.args["query"]
-                print(f"    [Agent C: Mapping] Generated SQL: {sql_q}")
-                
-                data_result = execute_bigquery_request(sql_q)
-                
-                full_result = {
-                    "request": user_query,
-                    "context_used": "SQL context summary...",
-                    "generated_map_sql": sql_q,
-                    "map_data_result": data_result
-                }
-
-                response = chat.send_message(
-                    Part.from_function_response(name="run_map_sql", response={"content": data_result})
-                )
-                final_output = full_result
-                
-        except Exception as e:
-            final_output = {"error": f"Mapping Agent Internal Error: {e}"}
-            break
+    try:
+        loop = run_tool_loop(chat, user_query, {"run_map_sql": run_map_sql}, name="Agent C: Mapping", max_turns=5)
+        call = loop.last_call("run_map_sql")
+        if call is not None:
+            final_output = {
+                "request": user_query,
+                "context_used": "SQL context summary...",
+                "generated_map_sql": call.args["query"],
+                "map_data_result": call.result
+            }
+    except Exception as e:
+        final_output = {"error": f"Mapping Agent Internal Error: {e}"}
 
     return final_output
 
@@ -320,43 +213,44 @@ def orchestrator_dispatch(user_prompt: str) -> str:
         )
     ])
 
+    system_prompt = "You are the Orchestrator. Analyze the user request and call the appropriate Specialist Agent once. Then, synthesize the agent's output into a natural, conversational response for the user."
+
     model = GenerativeModel(
         "gemini-2.5-flash",
-        system_instruction="You are the Orchestrator. Analyze the user request and call the appropriate Specialist Agent once. Then, synthesize the agent's output into a natural, conversational response for the user.",
+        system_instruction=system_prompt,
         tools=[tools]
     )
     
-    chat = model.start_chat()
-    # print("Orchestrator: Chat session created")
-    response = chat.send_message(user_prompt)
-    # print("Response received, maybe")
+    chat = cached_chat(model.start_chat(), "gemini-2.5-flash", system_prompt, [tools])
+
+    def delegate(func_name, agent):
+        def run(args):
+            arg_request = args["request"]
+            print(f"\n  [Orchestrator] Delegating to: {func_name} with query: '{arg_request}'")
+            agent_output = agent(arg_request)
+            print(f"\n  [Orchestrator] Received result. Synthesizing...")
+            return agent_output
+        return run
+
     final_response = "I'm not sure how to handle that request."
     
     try:
-        # Loop for Orchestrator to potentially call multiple agents if needed (though instruction says once)
-        while response.candidates[0].content.parts[0].function_call:
-            fn = response.candidates[0].content.parts[0].function_call
-            func_name = fn.name
-            arg_request = fn.args["request"]
-            
-            print(f"\n  [Orchestrator] Delegating to: {func_name} with query: '{arg_request}'")
-            
-            agent_output = {}
-            if func_name == "call_sql_agent":
-                agent_output = agent_text_to_sql(arg_request)
-            elif func_name == "call_rag_agent":
-                agent_output = agent_rag(arg_request)
-            elif func_name == "call_map_agent":
-                agent_output = agent_mapping(arg_request)
-            
-            print(f"\n  [Orchestrator] Received result. Synthesizing...")
-            
-            response = chat.send_message(
-                Part.from_function_response(name=func_name, response={"agent_output": agent_output})
-            )
-            final_response = response.text
-        else:
-            final_response = response.text
+        # Loop for Orchestrator to potentially call multiple agents if needed (though instruction says once).
+        # Delegates run one at a time in call order: the Map Agent reads the SQL Agent's context.
+        loop = run_tool_loop(
+            chat,
+            user_prompt,
+            {
+                "call_sql_agent": delegate("call_sql_agent", agent_text_to_sql),
+                "call_rag_agent": delegate("call_rag_agent", agent_rag),
+                "call_map_agent": delegate("call_map_agent", agent_mapping),
+            },
+            name="Orchestrator",
+            response_key="agent_output",
+            wrap_up=True,
+            max_parallel=1,
+        )
+        final_response = loop.text or final_response
             
     except Exception as e:
         final_response = f"❌ Orchestrator Error: {e}"
@@ -0,0 +1,416 @@
+"""
+Shared Gemini tool-call loop.
+
+Every agent (graph specialists, the app.py orchestrator, the CLI tester) sends a
+message, executes the function calls the model asks for and sends the results
+back until the model answers in text. This module runs that loop once, with:
+
+- a turn limit, a wall-clock budget and a token budget,
+- a stop on runaway retries (the same call repeated, or consecutive tool errors),
+- per-turn timing split into LLM time and tool time,
+- parallel execution of all function calls the model returns in one response,
+- optional token streaming of model text (`on_text`),
+- tool_call / tool_result progress events (events.py) for whoever installed a sink,
+- a tracing span per LLM turn and per tool call (tracing.py).
+
+Handlers map a function name to a callable taking the call's args (dict) and
+returning the JSON-able tool result. Handlers raising are reported back to the
+model as {"error": ...} so it can recover. Calls of one response may run on
+worker threads in any order, so handlers should not record "the last call"
+themselves; read it from `LoopResult.last_call` (call order) after the loop.
+"""
+
+import asyncio
+import contextvars
+import inspect
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+
+from vertexai.generative_models import ChatSession, Part
+
+from events import emit, result_rows
+from tracing import span
+
+# --- CONFIGURATION ---
+TOOL_LOOP_MAX_TURNS = int(os.environ.get("TOOL_LOOP_MAX_TURNS", "10"))
+TOOL_LOOP_TIME_BUDGET_S = float(os.environ.get("TOOL_LOOP_TIME_BUDGET_S", "180"))
+TOOL_LOOP_TOKEN_BUDGET = int(os.environ.get("TOOL_LOOP_TOKEN_BUDGET", "400000"))
+# Identical calls (same function and args) allowed before the loop is stopped
+TOOL_LOOP_MAX_REPEATS = int(os.environ.get("TOOL_LOOP_MAX_REPEATS", "2"))
+# Consecutive tool results carrying an "error" before the loop is stopped
+TOOL_LOOP_MAX_ERRORS = int(os.environ.get("TOOL_LOOP_MAX_ERRORS", "4"))
+# Function calls from one model response executed at the same time
+TOOL_LOOP_MAX_PARALLEL = int(os.environ.get("TOOL_LOOP_MAX_PARALLEL", "4"))
+
+@dataclass
+class TurnTiming:
+    turn: int
+    llm_s: float
+    tool_s: float = 0.0
+    tools: List[str] = field(default_factory=list)
+    tokens: int = 0
+
+@dataclass
+class ToolCall:
+    name: str
+    args: Dict[str, Any]
+    result: Any
+
+@dataclass
+class LoopResult:
+    response: Any
+    stop_reason: str  # "done", "max_turns", "time_budget", "token_budget", "repeated_call", "tool_errors"
+    turns: List[TurnTiming] = field(default_factory=list)
+    elapsed_s: float = 0.0
+    # Executed calls in the order the model issued them (batch by batch), not completion order
+    calls: List[ToolCall] = field(default_factory=list)
+
+    def last_call(self, name: str) -> Optional[ToolCall]:
+        """The most recently issued completed call to `name`, or None."""
+        return next((c for c in reversed(self.calls) if c.name == name), None)
+
+    @property
+    def text(self) -> str:
+        """Final model text ("" if the loop stopped on a pending function call)."""
+        try:
+            return self.response.text
+        except Exception:
+            return ""
+
+    @property
+    def llm_s(self) -> float:
+        return sum(t.llm_s for t in self.turns)
+
+    @property
+    def tool_s(self) -> float:
+        return sum(t.tool_s for t in self.turns)
+
+    @property
+    def tokens(self) -> int:
+        return sum(t.tokens for t in self.turns)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "stop_reason": self.stop_reason,
+            "turns": len(self.turns),
+            "elapsed_s": round(self.elapsed_s, 3),
+            "llm_s": round(self.llm_s, 3),
+            "tool_s": round(self.tool_s, 3),
+            "tokens": self.tokens,
+        }
+
+def function_calls(response) -> list:
+    """All function calls in the model's response (empty if it answered in text)."""
+    if not response.candidates:
+        return []
+    return [part.function_call for part in response.candidates[0].content.parts if part.function_call]
+
+class StreamedResponse:
+    """A streamed turn put back together (from the chat history), shaped like a GenerationResponse."""
+
+    def __init__(self, content, usage_metadata=None):
+        self.candidates = [SimpleNamespace(content=content)]
+        self.usage_metadata = usage_metadata
+
+    @property
+    def text(self) -> str:
+        return "".join(_part_text(part) for part in self.candidates[0].content.parts)
+
+def _part_text(part) -> str:
+    try:
+        return part.text
+    except (AttributeError, ValueError):
+        # function_call parts have no text
+        return ""
+
+def _chunk_text(chunk) -> str:
+    if not chunk.candidates:
+        return ""
+    return "".join(_part_text(part) for part in chunk.candidates[0].content.parts)
+
+def stream_turn(chat: ChatSession, message, on_text: Callable[[str], None]) -> StreamedResponse:
+    """Sends `message` with stream=True, passing each text delta to `on_text` as it arrives."""
+    usage = None
+    for chunk in chat.send_message(message, stream=True):
+        text = _chunk_text(chunk)
+        if text:
+            on_text(text)
+        usage = getattr(chunk, "usage_metadata", None) or usage
+    # The session appends the aggregated model turn once the stream is consumed
+    return StreamedResponse(chat.history[-1], usage)
+
+async def stream_turn_async(chat: ChatSession, message, on_text: Callable[[str], None]) -> StreamedResponse:
+    """Async variant of stream_turn."""
+    usage = None
+    async for chunk in await chat.send_message_async(message, stream=True):
+        text = _chunk_text(chunk)
+        if text:
+            on_text(text)
+        usage = getattr(chunk, "usage_metadata", None) or usage
+    return StreamedResponse(chat.history[-1], usage)
+
+def response_tokens(response) -> int:
+    usage = getattr(response, "usage_metadata", None)
+    return int(getattr(usage, "total_token_count", 0) or 0)
+
+class _LoopGuard:
+    """Budget and runaway-retry bookkeeping shared by the sync and async loops."""
+
+    def __init__(self, name, max_turns, time_budget_s, token_budget):
+        self.name = name
+        self.max_turns = max_turns
+        self.time_budget_s = time_budget_s
+        self.token_budget = token_budget
+        self.started = time.perf_counter()
+        self.turns: List[TurnTiming] = []
+        self.call_counts: Dict[str, int] = {}
+        self.consecutive_errors = 0
+        self.calls: List[ToolCall] = []
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def remaining(self) -> float:
+        return self.time_budget_s - self.elapsed()
+
+    def record_llm(self, llm_s: float, response):
+        self.turns.append(TurnTiming(turn=len(self.turns) + 1, llm_s=llm_s, tokens=response_tokens(response)))
+
+    def check_calls(self, calls) -> Optional[str]:
+        """Stop reason before executing a batch of calls, or None to go ahead."""
+        if len(self.turns) > self.max_turns:
+            return "max_turns"
+        if self.remaining() <= 0:
+            return "time_budget"
+        if sum(t.tokens for t in self.turns) > self.token_budget:
+            return "token_budget"
+        for fn in calls:
+            key = fn.name + json.dumps(dict(fn.args), sort_keys=True, default=str)
+            self.call_counts[key] = self.call_counts.get(key, 0) + 1
+            if self.call_counts[key] > TOOL_LOOP_MAX_REPEATS:
+                return "repeated_call"
+        if self.consecutive_errors >= TOOL_LOOP_MAX_ERRORS:
+            return "tool_errors"
+        return None
+
+    def record_tools(self, calls, tool_s: float, results):
+        """Records a batch of calls run concurrently: `tool_s` is the wall time of the whole batch."""
+        turn = self.turns[-1]
+        turn.tool_s += tool_s
+        turn.tools.extend(fn.name for fn in calls)
+        self.calls.extend(ToolCall(fn.name, dict(fn.args), result) for fn, result in zip(calls, results))
+        for result in results:
+            failed = isinstance(result, dict) and "error" in result
+            self.consecutive_errors = self.consecutive_errors + 1 if failed else 0
+        print(f"    [Tool Loop: {self.name}] turn {turn.turn}: llm {turn.llm_s:.2f}s, "
+              f"tools {tool_s:.2f}s ({', '.join(fn.name for fn in calls)}), {turn.tokens} tokens")
+
+    def finish(self, response, stop_reason: str) -> LoopResult:
+        result = LoopResult(response=response, stop_reason=stop_reason, turns=self.turns, elapsed_s=self.elapsed(),
+                            calls=self.calls)
+        print(f"    [Tool Loop: {self.name}] {result.summary()}")
+        return result
+
+def _budget_message(stop_reason: str) -> Dict[str, str]:
+    return {"error": f"Tool budget exhausted ({stop_reason}). Do not call any more tools; "
+                     f"answer with the information gathered so far."}
+
+def _unknown(fn) -> Dict[str, str]:
+    return {"error": f"Unknown function: {fn.name}"}
+
+def _response_parts(calls, results, response_key: str) -> List[Part]:
+    """One function response per call, in call order, sent back together in a single turn."""
+    return [
+        Part.from_function_response(name=fn.name, response={response_key: result})
+        for fn, result in zip(calls, results)
+    ]
+
+def _call_handler(handlers, fn):
+    handler = handlers.get(fn.name)
+    try:
+        return handler(dict(fn.args)) if handler else _unknown(fn)
+    except Exception as e:
+        return {"error": f"{fn.name} failed: {e}"}
+
+def _timed_call(handlers, fn):
+    """(result, elapsed seconds) of a sync handler call."""
+    t0 = time.perf_counter()
+    with span("tool_call", tool=fn.name):
+        result = _call_handler(handlers, fn)
+    return result, time.perf_counter() - t0
+
+def _traced_send(send, name: str, guard: "_LoopGuard"):
+    """`send` wrapped in an llm_turn span."""
+    def traced_send(message):
+        with span("llm_turn", agent=name, turn=len(guard.turns) + 1) as current:
+            response = send(message)
+            current.set_attribute("tokens", response_tokens(response))
+            return response
+    return traced_send
+
+def _traced_send_async(send, name: str, guard: "_LoopGuard"):
+    async def traced_send(message):
+        with span("llm_turn", agent=name, turn=len(guard.turns) + 1) as current:
+            response = await send(message)
+            current.set_attribute("tokens", response_tokens(response))
+            return response
+    return traced_send
+
+def _emit_calls(name: str, calls):
+    for fn in calls:
+        emit("tool_call", name, tool=fn.name, args=dict(fn.args))
+
+def _emit_results(name: str, calls, timed):
+    # Emitted from the loop's own thread: worker threads don't carry the caller's event sink
+    for fn, (result, elapsed_s) in zip(calls, timed):
+        emit("tool_result", name, tool=fn.name, elapsed_s=elapsed_s, rows=result_rows(result),
+             error=isinstance(result, dict) and "error" in result)
+
+async def _in_order(call, calls) -> list:
+    return [await call(fn) for fn in calls]
+
+def run_tool_loop(
+    chat: ChatSession,
+    message,
+    handlers: Dict[str, Callable[[Dict[str, Any]], Any]],
+    name: str = "agent",
+    max_turns: int = TOOL_LOOP_MAX_TURNS,
+    time_budget_s: float = TOOL_LOOP_TIME_BUDGET_S,
+    token_budget: int = TOOL_LOOP_TOKEN_BUDGET,
+    response_key: str = "content",
+    wrap_up: bool = False,
+    on_calls: Optional[Callable[[list], None]] = None,
+    on_text: Optional[Callable[[str], None]] = None,
+    max_parallel: int = TOOL_LOOP_MAX_PARALLEL,
+) -> LoopResult:
+    """
+    Sends `message` and executes tool calls until the model answers in text or a budget runs out.
+    With `on_text`, every model turn is streamed and its text deltas are passed to it as they arrive.
+
+    When the model returns several function calls in one response they run concurrently
+    (worker threads, so handlers must not touch thread-bound state such as Streamlit
+    elements) and all results go back in one turn; max_parallel=1 runs them one at a time,
+    in call order, for handlers that depend on each other. `on_calls` is invoked on the
+    calling thread with each batch before it runs, e.g. to display it.
+    With `wrap_up`, a stopped loop answers the pending calls with a budget error so the model
+    replies in text and the chat history stays valid for the next user turn.
+    """
+    guard = _LoopGuard(name, max_turns, time_budget_s, token_budget)
+    send = _traced_send((lambda m: stream_turn(chat, m, on_text)) if on_text else chat.send_message, name, guard)
+
+    t0 = time.perf_counter()
+    response = send(message)
+    guard.record_llm(time.perf_counter() - t0, response)
+
+    while calls := function_calls(response):
+        stop_reason = guard.check_calls(calls)
+        if stop_reason is not None:
+            if wrap_up:
+                response = send(_response_parts(calls, [_budget_message(stop_reason)] * len(calls), response_key))
+            return guard.finish(response, stop_reason)
+
+        if on_calls is not None:
+            on_calls(calls)
+        _emit_calls(name, calls)
+
+        t0 = time.perf_counter()
+        if len(calls) == 1 or max_parallel <= 1:
+            timed = [_timed_call(handlers, fn) for fn in calls]
+        else:
+            # Each worker runs in a copy of this context, so its spans nest under the current turn
+            contexts = [contextvars.copy_context() for _ in calls]
+            with ThreadPoolExecutor(max_workers=min(len(calls), max_parallel)) as pool:
+                timed = list(pool.map(lambda fn, ctx: ctx.run(_timed_call, handlers, fn), calls, contexts))
+        results = [result for result, _ in timed]
+        guard.record_tools(calls, time.perf_counter() - t0, results)
+        _emit_results(name, calls, timed)
+
+        t0 = time.perf_counter()
+        response = send(_response_parts(calls, results, response_key))
+        guard.record_llm(time.perf_counter() - t0, response)
+
+    return guard.finish(response, "done")
+
+async def run_tool_loop_async(
+    chat: ChatSession,
+    message,
+    handlers: Dict[str, Callable[[Dict[str, Any]], Any]],
+    name: str = "agent",
+    max_turns: int = TOOL_LOOP_MAX_TURNS,
+    time_budget_s: float = TOOL_LOOP_TIME_BUDGET_S,
+    token_budget: int = TOOL_LOOP_TOKEN_BUDGET,
+    response_key: str = "content",
+    wrap_up: bool = False,
+    on_calls: Optional[Callable[[list], None]] = None,
+    on_text: Optional[Callable[[str], None]] = None,
+    max_parallel: int = TOOL_LOOP_MAX_PARALLEL,
+) -> LoopResult:
+    """
+    Async variant of run_tool_loop. Handlers may be sync or async; the calls of one response
+    are gathered concurrently (one at a time with max_parallel=1). The time budget is a hard deadline here: LLM or tool calls
+    still running when it expires are cancelled.
+    """
+    guard = _LoopGuard(name, max_turns, time_budget_s, token_budget)
+    send = _traced_send_async(
+        (lambda m: stream_turn_async(chat, m, on_text)) if on_text else chat.send_message_async, name, guard
+    )
+
+    async def bounded(awaitable):
+        return await asyncio.wait_for(awaitable, timeout=max(guard.remaining(), 0.001))
+
+    async def call(fn):
+        t0 = time.perf_counter()
+        with span("tool_call", tool=fn.name):
+            result = _call_handler(handlers, fn)
+            if inspect.isawaitable(result):
+                try:
+                    result = await result
+                except Exception as e:
+                    result = {"error": f"{fn.name} failed: {e}"}
+        return result, time.perf_counter() - t0
+
+    try:
+        t0 = time.perf_counter()
+        response = await bounded(send(message))
+        guard.record_llm(time.perf_counter() - t0, response)
+    except asyncio.TimeoutError:
+        return guard.finish(None, "time_budget")
+
+    while calls := function_calls(response):
+        stop_reason = guard.check_calls(calls)
+        if stop_reason is None:
+            if on_calls is not None:
+                on_calls(calls)
+            _emit_calls(name, calls)
+            t0 = time.perf_counter()
+            try:
+                if max_parallel <= 1:
+                    timed = await bounded(_in_order(call, calls))
+                else:
+                    timed = await bounded(asyncio.gather(*(call(fn) for fn in calls)))
+                results = [result for result, _ in timed]
+                guard.record_tools(calls, time.perf_counter() - t0, results)
+                _emit_results(name, calls, timed)
+            except asyncio.TimeoutError:
+                stop_reason = "time_budget"
+
+        if stop_reason is not None:
+            if wrap_up:
+                response = await send(
+                    _response_parts(calls, [_budget_message(stop_reason)] * len(calls), response_key)
+                )
+            return guard.finish(response, stop_reason)
+
+        try:
+            t0 = time.perf_counter()
+            response = await bounded(send(_response_parts(calls, results, response_key)))
+            guard.record_llm(time.perf_counter() - t0, response)
+        except asyncio.TimeoutError:
+            return guard.finish(response, "time_budget")
+
+    return guard.finish(response, "done")
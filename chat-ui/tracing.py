@@ -0,0 +1,81 @@
+"""
+OpenTelemetry tracing for the chat UI and the agents.
+
+Spans cover graph nodes, LLM turns, tool calls, the SQL tool hop (including ID
+token minting) and RAG searches. The W3C `traceparent` header is injected into
+SQL tool requests, so the tool's spans (query submit, result wait, row
+conversion, serialization) join the same trace.
+
+TRACE_EXPORTER selects where finished spans go:
+- "none" (default): no SDK is installed, spans are no-ops,
+- "console": printed as JSON when they end,
+- "memory": kept in `memory_exporter` (offline tests, benchmarks).
+"""
+
+import inspect
+import os
+from contextlib import contextmanager
+from functools import wraps
+from typing import Dict, Optional
+
+from opentelemetry import propagate, trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import ConsoleSpanExporter, SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+# --- CONFIGURATION ---
+TRACE_EXPORTER = os.environ.get("TRACE_EXPORTER", "none")  # none | console | memory
+SERVICE_NAME = os.environ.get("TRACE_SERVICE_NAME", "resilitix-chat-ui")
+
+tracer = trace.get_tracer("resilitix.chat-ui")
+
+# Set when TRACE_EXPORTER=memory (or by configure_tracing("memory"))
+memory_exporter: Optional[InMemorySpanExporter] = None
+
+def configure_tracing(exporter: str = TRACE_EXPORTER) -> Optional[InMemorySpanExporter]:
+    """Installs a tracer provider for `exporter`. Returns the in-memory exporter in "memory" mode."""
+    global memory_exporter
+    if exporter == "none":
+        return None
+    if exporter == "memory":
+        memory_exporter = InMemorySpanExporter()
+        span_exporter = memory_exporter
+    else:
+        span_exporter = ConsoleSpanExporter()
+    provider = TracerProvider(resource=Resource.create({"service.name": SERVICE_NAME}))
+    provider.add_span_processor(SimpleSpanProcessor(span_exporter))
+    trace.set_tracer_provider(provider)
+    return memory_exporter
+
+@contextmanager
+def span(name: str, **attributes):
+    """Runs the block in a child span of the current one. None-valued attributes are skipped."""
+    with tracer.start_as_current_span(
+        name, attributes={k: v for k, v in attributes.items() if v is not None}
+    ) as current:
+        yield current
+
+def traced(name: str):
+    """Decorator: runs each call of a sync or async function in a span named `name`."""
+    def decorate(func):
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def inject_headers(headers: Dict[str, str]) -> Dict[str, str]:
+    """Adds the W3C trace context (traceparent / tracestate) of the current span to `headers`."""
+    propagate.inject(headers)
+    return headers
+
+configure_tracing()
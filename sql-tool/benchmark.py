@@ -0,0 +1,312 @@
+"""
+Load and throughput benchmark for the SQL tool (main.py).
+
+Requests go through the real functions-framework app (request parsing, content
+negotiation, serialization, Flask response) with bigquery.Client replaced by a
+stub that returns synthetic result sets (LIMIT n rows), so the benchmark runs
+offline and measures the service's own cost.
+
+For every response format (JSON, NDJSON, Arrow) and result size it reports:
+- requests/sec and p50 / p99 latency (BENCH_CONCURRENCY client threads),
+- peak RSS while the case ran,
+- output time (row conversion + serialization) per request, read from the
+  tool's own tracing spans: rows.convert + json.dumps, rows.convert +
+  arrow.ipc, or ndjson.stream (which converts and serializes page by page).
+
+Every format produces its rows from the stub on each request, so the output
+time covers the same stages for all of them.
+
+Results are compared with a baseline file; BENCH_UPDATE_BASELINE=1 rewrites it.
+The process exits with status 1 when a case regresses beyond BENCH_TOLERANCE.
+
+main.py's doctests run first, against the same stub (main.py cannot be
+imported without BigQuery credentials otherwise); `--check` runs only those.
+
+    python benchmark.py
+    python benchmark.py --check
+    BENCH_ROWS=10,1000 BENCH_UPDATE_BASELINE=1 python benchmark.py
+"""
+
+import contextlib
+import datetime
+import doctest
+import io
+import json
+import os
+import platform
+import re
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow as pa
+from google.cloud import bigquery
+
+# --- CONFIGURATION ---
+BENCH_ROWS = [int(n) for n in os.environ.get("BENCH_ROWS", "10,1000,100000,1000000").split(",")]
+BENCH_FORMATS = os.environ.get(
+    "BENCH_FORMATS", "application/json,application/x-ndjson,application/vnd.apache.arrow.stream"
+).split(",")
+# Requests per case (0 = scale with the result size)
+BENCH_REQUESTS = int(os.environ.get("BENCH_REQUESTS", "0"))
+BENCH_CONCURRENCY = int(os.environ.get("BENCH_CONCURRENCY", "4"))
+# Keep the tool's result cache out of the measurement unless asked for
+BENCH_USE_CACHE = os.environ.get("BENCH_USE_CACHE", "0") == "1"
+BENCH_BASELINE = os.environ.get("BENCH_BASELINE", os.path.join(os.path.dirname(__file__), "benchmark_baseline.json"))
+BENCH_UPDATE_BASELINE = os.environ.get("BENCH_UPDATE_BASELINE", "0") == "1"
+# Allowed slowdown against the baseline (0.25 = 25% fewer req/s or 25% higher p99)
+BENCH_TOLERANCE = float(os.environ.get("BENCH_TOLERANCE", "0.25"))
+# p99 differences smaller than this are scheduler noise, not regressions
+BENCH_MIN_DELTA_MS = float(os.environ.get("BENCH_MIN_DELTA_MS", "20"))
+BENCH_VERBOSE = os.environ.get("BENCH_VERBOSE", "0") == "1"
+
+# Spans recorded by main.py for row conversion and serialization, per response format
+OUTPUT_SPANS = {
+    "application/json": ("rows.convert", "json.dumps"),
+    "application/x-ndjson": ("ndjson.stream",),
+    "application/vnd.apache.arrow.stream": ("rows.convert", "arrow.ipc"),
+}
+
+# --- BIGQUERY STUB ---
+
+_LIMIT_RE = re.compile(r"\bLIMIT\s+(\d+)", re.IGNORECASE)
+SYNTHETIC_UPDATED = datetime.date(2024, 1, 1)
+
+def synthetic_row(i: int) -> dict:
+    return {
+        "hex_id": f"86489e3{i:08x}",
+        "county": "Brazos",
+        "state": "Texas",
+        "value": (i % 1000) / 7.0,
+        "population": i * 13 % 100000,
+        "updated": SYNTHETIC_UPDATED,
+    }
+
+class FakeRowIterator:
+    """Stands in for bigquery.table.RowIterator: rows are generated on the fly, page by page."""
+
+    def __init__(self, n: int, page_size=None):
+        self.n = n
+        self.page_size = page_size or 10000
+        self.total_rows = n
+
+    def __iter__(self):
+        return (synthetic_row(i) for i in range(self.n))
+
+    @property
+    def pages(self):
+        for start in range(0, self.n, self.page_size):
+            yield [synthetic_row(i) for i in range(start, min(start + self.page_size, self.n))]
+
+    def to_arrow(self) -> pa.Table:
+        # Built per call from the same rows as the iterator, so Arrow pays for row production too
+        return pa.Table.from_pylist(list(self))
+
+class FakeQueryJob:
+    def __init__(self, n: int):
+        self.n = n
+        self.total_bytes_processed = n * 64
+        self.schema = [bigquery.SchemaField(name, "STRING") for name in synthetic_row(0)]
+
+    def result(self, page_size=None, **kwargs) -> FakeRowIterator:
+        return FakeRowIterator(self.n, page_size)
+
+class FakeBigQueryClient:
+    """bigquery.Client stand-in: a query returns as many rows as its LIMIT asks for."""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def query(self, sql: str, job_config=None) -> FakeQueryJob:
+        match = _LIMIT_RE.search(sql)
+        return FakeQueryJob(int(match.group(1)) if match else 10)
+
+# --- MEASUREMENT ---
+
+def current_rss() -> int:
+    """Resident set size in bytes (Linux /proc, else the process peak from getrusage)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # ru_maxrss is in KiB on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+class PeakRSS:
+    """Samples RSS in a background thread while the block runs."""
+
+    def __init__(self, interval_s: float = 0.005):
+        self.interval_s = interval_s
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss())
+            time.sleep(self.interval_s)
+
+    def __enter__(self):
+        self.start = current_rss()
+        self.peak = self.start
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+def percentile(values, q: float) -> float:
+    """q-th percentile (0-100) with linear interpolation."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def requests_for(rows: int) -> int:
+    """Enough requests for stable numbers without spending minutes on the 1M-row case."""
+    if BENCH_REQUESTS:
+        return BENCH_REQUESTS
+    return max(3, min(200, 2_000_000 // max(rows, 1)))
+
+# --- BENCHMARK ---
+
+def load_app():
+    """Builds the functions-framework app around main.py with the BigQuery stub and in-memory tracing."""
+    os.environ["TRACE_EXPORTER"] = "memory"
+    bigquery.Client = FakeBigQueryClient
+    import functions_framework
+    app = functions_framework.create_app(
+        target="execute_bigquery_sql", source=os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    )
+    # The framework loads main.py itself and registers it as sys.modules["main"]
+    return app, sys.modules["main"]
+
+def run_case(app, main, response_format: str, rows: int) -> dict:
+    payload = {"query": f"SELECT * FROM synthetic.results LIMIT {rows}", "no_cache": not BENCH_USE_CACHE}
+    headers = {"Accept": response_format}
+    local = threading.local()
+
+    def one_request():
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        t0 = time.perf_counter()
+        response = local.client.post("/", json=payload, headers=headers)
+        body = response.get_data()  # drains streamed (NDJSON) bodies too
+        elapsed = time.perf_counter() - t0
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}: {body[:200]!r}")
+        return elapsed, len(body)
+
+    count = requests_for(rows)
+    # The tool logs every query; keep the report readable unless asked otherwise
+    quiet = contextlib.nullcontext() if BENCH_VERBOSE else contextlib.redirect_stdout(io.StringIO())
+    with quiet:
+        one_request()  # warm-up (imports, first-use setup)
+        main.memory_exporter.clear()
+
+        with PeakRSS() as rss:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=BENCH_CONCURRENCY) as pool:
+                timings = list(pool.map(lambda _: one_request(), range(count)))
+            wall_s = time.perf_counter() - started
+
+    latencies = [t for t, _ in timings]
+    # Each request is its own trace; sum its conversion and serialization spans
+    span_names = OUTPUT_SPANS.get(response_format, ())
+    output_s = {}
+    for s in main.memory_exporter.get_finished_spans():
+        if s.name in span_names:
+            trace_id = s.context.trace_id
+            output_s[trace_id] = output_s.get(trace_id, 0.0) + (s.end_time - s.start_time) / 1e9
+    return {
+        "format": response_format,
+        "rows": rows,
+        "requests": count,
+        "body_bytes": timings[0][1],
+        "requests_per_s": round(count / wall_s, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "output_p50_ms": round(percentile(list(output_s.values()), 50) * 1000, 2),
+        "peak_rss_mb": round(rss.peak / 1024 ** 2, 1),
+        "rss_growth_mb": round((rss.peak - rss.start) / 1024 ** 2, 1),
+    }
+
+def case_key(case: dict) -> str:
+    return f"{case['format']}|{case['rows']}"
+
+def compare(cases, baseline) -> list:
+    """Regression messages for cases slower than the baseline beyond BENCH_TOLERANCE."""
+    previous = {case_key(c): c for c in baseline.get("cases", [])}
+    regressions = []
+    for case in cases:
+        old = previous.get(case_key(case))
+        if old is None:
+            continue
+        if case["requests_per_s"] < old["requests_per_s"] * (1 - BENCH_TOLERANCE):
+            regressions.append(f"{case_key(case)}: {case['requests_per_s']} req/s (baseline {old['requests_per_s']})")
+        if case["p99_ms"] > max(old["p99_ms"] * (1 + BENCH_TOLERANCE), old["p99_ms"] + BENCH_MIN_DELTA_MS):
+            regressions.append(f"{case_key(case)}: p99 {case['p99_ms']} ms (baseline {old['p99_ms']})")
+    return regressions
+
+def print_cases(cases, baseline):
+    previous = {case_key(c): c for c in baseline.get("cases", [])}
+    print(f"\n{'format':<38}{'rows':>9}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}"
+          f"{'out. ms':>10}{'peak MB':>9}{'vs base':>9}")
+    for c in cases:
+        old = previous.get(case_key(c))
+        ratio = f"{c['requests_per_s'] / old['requests_per_s']:.2f}x" if old and old["requests_per_s"] else "-"
+        print(f"{c['format']:<38}{c['rows']:>9}{c['requests_per_s']:>10}{c['p50_ms']:>10}{c['p99_ms']:>10}"
+              f"{c['output_p50_ms']:>10}{c['peak_rss_mb']:>9}{ratio:>9}")
+
+def main():
+    app, tool = load_app()
+
+    # Offline regression checks on the tool's pure helpers (e.g. normalize_sql)
+    checks = doctest.testmod(tool)
+    print(f"Doctests: {checks.attempted - checks.failed}/{checks.attempted} passed")
+    if checks.failed or "--check" in sys.argv:
+        sys.exit(1 if checks.failed else 0)
+
+    cases = []
+    for rows in BENCH_ROWS:
+        for response_format in BENCH_FORMATS:
+            print(f"Benchmarking {response_format} x {rows} rows...", flush=True)
+            cases.append(run_case(app, tool, response_format, rows))
+
+    baseline = {}
+    if os.path.exists(BENCH_BASELINE):
+        with open(BENCH_BASELINE) as f:
+            baseline = json.load(f)
+
+    print_cases(cases, baseline)
+
+    if BENCH_UPDATE_BASELINE:
+        with open(BENCH_BASELINE, "w") as f:
+            json.dump({
+                "machine": {"python": platform.python_version(), "platform": platform.platform(),
+                            "cpus": os.cpu_count()},
+                "concurrency": BENCH_CONCURRENCY,
+                "cases": cases,
+            }, f, indent=2)
+        print(f"\nBaseline written to {BENCH_BASELINE}")
+        return
+
+    if baseline.get("machine", {}).get("platform") not in (None, platform.platform()):
+        print(f"\nNote: baseline recorded on {baseline['machine']['platform']}; compare with care.")
+    regressions = compare(cases, baseline)
+    if regressions:
+        print("\nRegressions against the baseline:")
+        for message in regressions:
+            print(f"  - {message}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
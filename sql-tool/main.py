@@ -1,13 +1,368 @@
 import functions_framework
+from flask import Response, stream_with_context
 from google.cloud import bigquery
+from collections import OrderedDict
+from contextlib import contextmanager
+from opentelemetry import propagate, trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import ConsoleSpanExporter, SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+import pyarrow as pa
+import hashlib
 import json
 import os
+import re
+import sqlite3
+import threading
+import time
 
 # Initialize BigQuery Client
 client = bigquery.Client()
 
+# Response formats (negotiated via the Accept header)
+JSON_MIMETYPE = "application/json"
+NDJSON_MIMETYPE = "application/x-ndjson"
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+
+# Rows fetched per BigQuery page while streaming NDJSON
+STREAM_PAGE_SIZE = int(os.environ.get("STREAM_PAGE_SIZE", "5000"))
+
+# Queries that would bill more than this many bytes are rejected (0 disables the guard).
+# Requests may ask for a lower limit with "max_bytes_billed", never a higher one.
+MAX_BYTES_BILLED = int(os.environ.get("MAX_BYTES_BILLED", str(100 * 1024 ** 3)))
+
+# Result cache settings
+QUERY_CACHE_BACKEND = os.environ.get("QUERY_CACHE_BACKEND", "memory")  # memory | sqlite | off
+QUERY_CACHE_PATH = os.environ.get("QUERY_CACHE_PATH", "/tmp/sql_tool_cache.sqlite")
+QUERY_CACHE_TTL_S = float(os.environ.get("QUERY_CACHE_TTL_S", "600"))
+QUERY_CACHE_MAX_BYTES = int(os.environ.get("QUERY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+QUERY_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("QUERY_CACHE_MAX_ENTRY_BYTES", str(8 * 1024 * 1024)))
+
+# Tracing: none (no-op spans) | console | memory (kept in memory_exporter, for offline tests)
+TRACE_EXPORTER = os.environ.get("TRACE_EXPORTER", "none")
+
+# --- TRACING ---
+
+memory_exporter = None
+
+def configure_tracing(exporter: str = TRACE_EXPORTER):
+    """Installs a tracer provider for `exporter`. Returns the in-memory exporter in "memory" mode."""
+    global memory_exporter
+    if exporter == "none":
+        return None
+    if exporter == "memory":
+        memory_exporter = InMemorySpanExporter()
+        span_exporter = memory_exporter
+    else:
+        span_exporter = ConsoleSpanExporter()
+    provider = TracerProvider(resource=Resource.create({"service.name": "resilitix-sql-tool"}))
+    provider.add_span_processor(SimpleSpanProcessor(span_exporter))
+    trace.set_tracer_provider(provider)
+    return memory_exporter
+
+configure_tracing()
+tracer = trace.get_tracer("resilitix.sql-tool")
+
+@contextmanager
+def span(name: str, context=None, **attributes):
+    """Child span of the current one (or of `context`, e.g. the caller's traceparent)."""
+    with tracer.start_as_current_span(name, context=context, attributes=attributes) as current:
+        yield current
+
+# --- RESULT CACHE ---
+
+# Literals / quoted identifiers (kept), or a run of whitespace and comments (collapsed)
+_SQL_TOKEN_RE = re.compile(
+    r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`)|(?:\s|--[^\n]*|#[^\n]*|/\*[\s\S]*?\*/)+"
+)
+
+def normalize_sql(sql: str) -> str:
+    """
+    Canonical form of a query for cache keys: comments removed, whitespace runs collapsed and
+    trailing semicolons dropped. Quoted literals and identifiers are left untouched.
+    A `--` or `#` comment ends at its newline, so it never swallows the line after it.
+
+    >>> normalize_sql("SELECT a  FROM t -- note\\nWHERE x = 1;")
+    'SELECT a FROM t WHERE x = 1'
+    >>> normalize_sql("SELECT a FROM t -- note WHERE x = 1")
+    'SELECT a FROM t'
+    >>> normalize_sql("SELECT '--  kept' FROM t")
+    "SELECT '--  kept' FROM t"
+    """
+    normalized = _SQL_TOKEN_RE.sub(lambda m: m.group(1) or " ", sql).strip()
+    return normalized.rstrip(";").rstrip()
+
+def is_cacheable(sql: str) -> bool:
+    """Only read-only statements are cached."""
+    return normalize_sql(sql).upper().startswith(("SELECT", "WITH"))
+
+class MemoryCacheBackend:
+    """In-process LRU store bounded by total value bytes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._size = 0
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.time():
+            self.delete(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: bytes, ttl: float) -> int:
+        """Stores a value and returns the number of entries evicted to make room."""
+        self.delete(key)
+        self._entries[key] = (time.time() + ttl, value)
+        self._size += len(value)
+
+        evicted = 0
+        while self._size > self.max_bytes and self._entries:
+            _, (_, old_value) = self._entries.popitem(last=False)
+            self._size -= len(old_value)
+            evicted += 1
+        return evicted
+
+    def delete(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+
+    def size_bytes(self) -> int:
+        return self._size
+
+class SQLiteCacheBackend:
+    """Local file store with the same LRU/TTL semantics. Survives restarts; handy for tests."""
+
+    def __init__(self, path: str, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS query_cache ("
+            "key TEXT PRIMARY KEY, value BLOB, size INTEGER, expires_at REAL, last_access REAL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str):
+        row = self._conn.execute("SELECT value, expires_at FROM query_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at < time.time():
+            self.delete(key)
+            return None
+        self._conn.execute("UPDATE query_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+        self._conn.commit()
+        return value
+
+    def set(self, key: str, value: bytes, ttl: float) -> int:
+        now = time.time()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO query_cache (key, value, size, expires_at, last_access) VALUES (?, ?, ?, ?, ?)",
+            (key, value, len(value), now + ttl, now),
+        )
+
+        evicted = 0
+        while self.size_bytes() > self.max_bytes:
+            oldest = self._conn.execute("SELECT key FROM query_cache ORDER BY last_access LIMIT 1").fetchone()
+            if oldest is None:
+                break
+            self._conn.execute("DELETE FROM query_cache WHERE key = ?", oldest)
+            evicted += 1
+        self._conn.commit()
+        return evicted
+
+    def delete(self, key: str):
+        self._conn.execute("DELETE FROM query_cache WHERE key = ?", (key,))
+        self._conn.commit()
+
+    def size_bytes(self) -> int:
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM query_cache").fetchone()[0]
+
+class QueryCache:
+    """
+    Result cache keyed by (response format, normalized SQL).
+    Values are the serialized response bodies, so a hit skips BigQuery and serialization.
+    """
+
+    def __init__(self, backend, ttl: float, max_entry_bytes: int):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_entry_bytes = max_entry_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(sql: str, response_format: str) -> str:
+        return hashlib.sha256(f"{response_format}\n{normalize_sql(sql)}".encode("utf-8")).hexdigest()
+
+    def get(self, sql: str, response_format: str):
+        key = self.make_key(sql, response_format)
+        with self._lock:
+            value = self.backend.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, sql: str, response_format: str, value: bytes):
+        if len(value) > self.max_entry_bytes:
+            return
+        key = self.make_key(sql, response_format)
+        with self._lock:
+            self.evictions += self.backend.set(key, value, self.ttl)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "backend": type(self.backend).__name__,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size_bytes": self.backend.size_bytes(),
+            }
+
+def build_query_cache():
+    """Creates the cache configured by QUERY_CACHE_BACKEND, or None when caching is off."""
+    if QUERY_CACHE_BACKEND == "off":
+        return None
+    if QUERY_CACHE_BACKEND == "sqlite":
+        backend = SQLiteCacheBackend(QUERY_CACHE_PATH, QUERY_CACHE_MAX_BYTES)
+    else:
+        backend = MemoryCacheBackend(QUERY_CACHE_MAX_BYTES)
+    return QueryCache(backend, QUERY_CACHE_TTL_S, QUERY_CACHE_MAX_ENTRY_BYTES)
+
+query_cache = build_query_cache()
+
+# --- SERIALIZATION ---
+
+def stream_ndjson(results, on_complete=None, trace_context=None):
+    """
+    Yields the query results as newline-delimited JSON, one row per line.
+    Rows are pulled page by page, so only one page is held in memory at a time.
+    If the download fails mid-stream, a final {"__error__": ...} line is emitted.
+
+    When on_complete is given, the body is also buffered (up to QUERY_CACHE_MAX_ENTRY_BYTES)
+    and handed to it once the stream finishes successfully.
+
+    The body is produced after the handler returns, so its span is parented on `trace_context`.
+    """
+    buffer = [] if on_complete else None
+    buffered_bytes = 0
+    with span("ndjson.stream", context=trace_context) as current:
+        rows = 0
+        try:
+            for page in results.pages:
+                page_rows = [dict(row) for row in page]
+                rows += len(page_rows)
+                chunk = "".join(json.dumps(row, default=str) + "\n" for row in page_rows)
+                if buffer is not None:
+                    buffered_bytes += len(chunk)
+                    if buffered_bytes > QUERY_CACHE_MAX_ENTRY_BYTES:
+                        buffer = None
+                    else:
+                        buffer.append(chunk)
+                yield chunk
+        except Exception as e:
+            print(f"BigQuery Stream Error: {str(e)}")
+            current.set_attribute("error", str(e))
+            yield json.dumps({"__error__": str(e)}) + "\n"
+            return
+        finally:
+            current.set_attribute("rows", rows)
+
+    if buffer is not None:
+        on_complete("".join(buffer).encode("utf-8"))
+
+def to_arrow_ipc(results) -> bytes:
+    """
+    Serializes the query results as an Arrow IPC stream.
+    Keeps BigQuery's column types (floats, ints, dates) instead of stringifying them.
+    """
+    with span("rows.convert", format="arrow"):
+        table = results.to_arrow()
+    with span("arrow.ipc", rows=table.num_rows):
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+
+# --- DRY RUN / COST GUARD ---
+
+def bytes_limit(request_json) -> int:
+    """Effective max-bytes limit for a request (0 = unlimited). Raises ValueError on a malformed value."""
+    requested = request_json.get("max_bytes_billed") or 0
+    try:
+        if isinstance(requested, bool) or not isinstance(requested, (int, str)):
+            raise ValueError
+        requested = int(requested)
+        if requested < 0:
+            raise ValueError
+    except ValueError:
+        raise ValueError(f"max_bytes_billed must be a non-negative integer, got {requested!r}") from None
+    if MAX_BYTES_BILLED and requested:
+        return min(requested, MAX_BYTES_BILLED)
+    return requested or MAX_BYTES_BILLED
+
+def job_config(limit: int, dry_run: bool = False):
+    if not limit and not dry_run:
+        return None
+    return bigquery.QueryJobConfig(
+        dry_run=dry_run,
+        use_query_cache=not dry_run,
+        maximum_bytes_billed=limit or None,
+    )
+
+def dry_run_query(sql_query: str, limit: int):
+    """
+    Validates a query without running it. Returns (body, status): bytes processed and result
+    schema, or the BigQuery error. A valid query above `limit` is reported as an error too,
+    so callers can repair it before it costs anything.
+    """
+    try:
+        with span("bigquery.dry_run"):
+            query_job = client.query(sql_query, job_config=job_config(limit, dry_run=True))
+    except Exception as e:
+        print(f"BigQuery Dry Run Error: {str(e)}")
+        return {"dry_run": True, "valid": False, "error": str(e)}, 400
+
+    total_bytes = query_job.total_bytes_processed or 0
+    body = {
+        "dry_run": True,
+        "valid": True,
+        "total_bytes_processed": total_bytes,
+        "max_bytes_billed": limit,
+        "schema": [{"name": f.name, "type": f.field_type} for f in (getattr(query_job, "schema", None) or [])],
+    }
+    if limit and total_bytes > limit:
+        body["valid"] = False
+        body["error"] = (
+            f"Query would process {total_bytes / 1024 ** 3:.2f} GiB, above the {limit / 1024 ** 3:.2f} GiB limit. "
+            f"Add filters (e.g. on location or date) or select fewer columns."
+        )
+    return body, 200
+
 @functions_framework.http
 def execute_bigquery_sql(request):
+    # Join the caller's trace when the request carries a W3C traceparent header
+    with span("execute_bigquery_sql", context=propagate.extract(request.headers), method=request.method):
+        return handle_request(request)
+
+def handle_request(request):
+    # 0. Cache statistics (GET)
+    if request.method == "GET":
+        stats = query_cache.stats() if query_cache else {"backend": "off"}
+        return (json.dumps(stats), 200, {'Content-Type': 'application/json'})
+
     # 1. Parse Request
     request_json = request.get_json(silent=True)
 
@@ -16,18 +371,70 @@ def execute_bigquery_sql(request):
         return (json.dumps({"error": "No query provided"}), 400, {'Content-Type': 'application/json'})
 
     sql_query = request_json['query']
-    print(f"Executing SQL: {sql_query}") 
+    print(f"Executing SQL: {sql_query}")
 
-    # 2. Run Query
     try:
-        query_job = client.query(sql_query)
-        results = query_job.result()
+        limit = bytes_limit(request_json)
+    except ValueError as e:
+        return (json.dumps({"error": str(e)}), 400, {'Content-Type': 'application/json'})
+
+    # 2. Dry Run (validate and estimate cost only)
+    if request_json.get("dry_run"):
+        body, status = dry_run_query(sql_query, limit)
+        return (json.dumps(body), status, {'Content-Type': 'application/json'})
+
+    response_format = request.accept_mimetypes.best_match([JSON_MIMETYPE, NDJSON_MIMETYPE, ARROW_MIMETYPE], default=JSON_MIMETYPE)
+
+    # 3. Check Result Cache
+    use_cache = query_cache is not None and not request_json.get("no_cache") and is_cacheable(sql_query)
+    if use_cache:
+        cached_body = query_cache.get(sql_query, response_format)
+        if cached_body is not None:
+            print("Cache HIT")
+            return (cached_body, 200, {'Content-Type': response_format, 'X-Cache': 'HIT'})
+
+    # 4. Dry-Run Gate ("check": true): invalid or over-limit SQL is rejected before it runs.
+    # After the cache lookup, so cached results come back without a dry-run job
+    if request_json.get("check"):
+        body, _ = dry_run_query(sql_query, limit)
+        if "error" in body:
+            print(f"Dry run rejected SQL: {body['error']}")
+            error = {"error": f"Query rejected by dry run (not executed): {body['error']}", "dry_run": body}
+            return (json.dumps(error), 400, {'Content-Type': 'application/json'})
+
+    # 5. Run Query (billing capped by the max-bytes guard)
+    try:
+        with span("bigquery.submit"):
+            query_job = client.query(sql_query, job_config=job_config(limit))
+
+        if response_format == NDJSON_MIMETYPE:
+            # Wait for the job here so query errors still surface as a 500 before streaming starts
+            with span("bigquery.wait"):
+                results = query_job.result(page_size=STREAM_PAGE_SIZE)
+            on_complete = (lambda body: query_cache.set(sql_query, response_format, body)) if use_cache else None
+            return Response(
+                stream_with_context(stream_ndjson(results, on_complete, trace.set_span_in_context(trace.get_current_span()))),
+                status=200,
+                mimetype=NDJSON_MIMETYPE,
+                headers={'X-Cache': 'MISS'},
+            )
+
+        with span("bigquery.wait"):
+            results = query_job.result()
+
+        if response_format == ARROW_MIMETYPE:
+            body = to_arrow_ipc(results)
+        else:
+            # Convert rows to dicts (iterating also downloads the result pages)
+            with span("rows.convert", format="json"):
+                rows = [dict(row) for row in results]
+            with span("json.dumps", rows=len(rows)):
+                body = json.dumps({"data": rows}, default=str)
 
-        # Convert rows to dicts
-        rows = [dict(row) for row in results]
+        if use_cache:
+            query_cache.set(sql_query, response_format, body if isinstance(body, bytes) else body.encode("utf-8"))
 
-        # Return JSON
-        return (json.dumps({"data": rows}, default=str), 200, {'Content-Type': 'application/json'})
+        return (body, 200, {'Content-Type': response_format, 'X-Cache': 'MISS'})
 
     except Exception as e:
         print(f"BigQuery Error: {str(e)}")